@@ -0,0 +1,260 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import sqlite3
+import threading
+from collections import OrderedDict
+from telemetry import registry
+
+ADMISSION_DB_PATH = os.getenv('ADMISSION_DB_PATH', 'admission.db')
+ADMISSION_MAX_RUNNING = int(os.getenv('ADMISSION_MAX_RUNNING', '32'))
+ADMISSION_QUEUE_SIZE = int(os.getenv('ADMISSION_QUEUE_SIZE', '64'))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '60'))
+ADMISSION_SLOT_LEASE = float(os.getenv('ADMISSION_SLOT_LEASE', '300'))
+ADMISSION_DEFAULT_TIER = os.getenv('ADMISSION_DEFAULT_TIER', 'free')
+ADMISSION_TIERS = json.loads(os.getenv('ADMISSION_TIERS', json.dumps({
+    'free': {'rate_per_minute': 10, 'burst': 5, 'concurrent': 2},
+    'pro': {'rate_per_minute': 60, 'burst': 20, 'concurrent': 5},
+})))
+TIER_CACHE_TTL = float(os.getenv('TIER_CACHE_TTL', '300'))
+TIER_CACHE_SIZE = 4096
+
+POLL_INTERVAL = 0.25
+# A waiter that stops polling (its process died) is dropped after this long
+WAITER_STALE_SECONDS = 10
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    user_id TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS slots (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS waiters (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT UNIQUE NOT NULL,
+    user_id TEXT NOT NULL,
+    heartbeat REAL NOT NULL
+);
+"""
+
+ADMITTED = registry.counter('admission_admitted_total', 'Agent runs admitted', ['tier'])
+REJECTED = registry.counter('admission_rejected_total', 'Agent requests rejected with 429', ['reason'])
+QUEUE_SECONDS = registry.histogram('admission_queue_seconds', 'Time admitted runs waited in the queue')
+
+
+class Tier:
+    def __init__(self, name, rate_per_minute, burst, concurrent):
+        self.name = name
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.concurrent = concurrent
+
+
+TIERS = {name: Tier(name, **limits) for name, limits in ADMISSION_TIERS.items()}
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason, message, retry_after=None):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """A request's place in line; `wait()` yields queue positions until it runs"""
+
+    def __init__(self, admission, ticket_id, user_id, tier):
+        self.admission = admission
+        self.id = ticket_id
+        self.user_id = user_id
+        self.tier = tier
+        self.enqueued_at = time.monotonic()
+        self.running = False
+        self.released = False
+
+    async def wait(self):
+        """Yield the 1-based queue position whenever it changes; return once admitted"""
+        last = None
+        while not self.running:
+            position = await asyncio.to_thread(self.admission._try_start, self)
+            if position == 0:
+                self.running = True
+                break
+            if time.monotonic() - self.enqueued_at > self.admission.queue_timeout:
+                REJECTED.inc(reason='queue_timeout')
+                raise AdmissionRejected('queue_timeout', 'The server is busy, please try again shortly')
+            if position != last:
+                last = position
+                yield position
+            await asyncio.sleep(POLL_INTERVAL)
+        ADMITTED.inc(tier=self.tier.name)
+        QUEUE_SECONDS.observe(time.monotonic() - self.enqueued_at)
+
+    async def release(self):
+        """Give up the run slot or queue place; later calls do nothing"""
+        if self.released:
+            return
+        self.released = True
+        await asyncio.to_thread(self.admission._release, self)
+
+
+class Admission:
+    """Rate limiting and a global cap on in-flight agent runs for /agent.
+
+    Each user has a token bucket sized by their tier. A request without a
+    token is rejected right away with 429 and a Retry-After, as is one that
+    would exceed the tier's concurrent requests, or one that finds the wait
+    queue full. Admitted requests take one of `max_running` run slots or
+    wait in FIFO order. All state lives in one SQLite file, so every uvicorn
+    worker using the same ADMISSION_DB_PATH enforces the same limits.
+    """
+
+    def __init__(self, path=ADMISSION_DB_PATH, max_running=ADMISSION_MAX_RUNNING, queue_size=ADMISSION_QUEUE_SIZE,
+                 queue_timeout=ADMISSION_QUEUE_TIMEOUT, slot_lease=ADMISSION_SLOT_LEASE, tiers=TIERS,
+                 default_tier=ADMISSION_DEFAULT_TIER):
+        self.path = path
+        self.max_running = max_running
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.slot_lease = slot_lease
+        self.tiers = tiers
+        self.default_tier = default_tier
+        self._conn = None
+        self._lock = threading.Lock()
+        self._tier_cache = OrderedDict()
+
+    @property
+    def enabled(self):
+        return self.max_running > 0
+
+    async def tier_for(self, db, user_id):
+        """The user's tier from the `tier` field of their services document, cached briefly"""
+        cached = self._tier_cache.get(user_id)
+        if cached and cached[1] > time.monotonic():
+            return self.tiers.get(cached[0]) or self.tiers[self.default_tier]
+        name = self.default_tier
+        try:
+            doc = await db.collection('services').document(user_id).get(field_paths=['tier'])
+            if doc.exists:
+                name = doc.to_dict().get('tier') or self.default_tier
+        except Exception as e:
+            print(f"Could not read tier for {user_id}: {e}")
+        self._tier_cache[user_id] = (name, time.monotonic() + TIER_CACHE_TTL)
+        self._tier_cache.move_to_end(user_id)
+        while len(self._tier_cache) > TIER_CACHE_SIZE:
+            self._tier_cache.popitem(last=False)
+        return self.tiers.get(name) or self.tiers[self.default_tier]
+
+    async def admit(self, user_id, tier):
+        """Take a rate-limit token and join the queue, or raise AdmissionRejected"""
+        ticket = Ticket(self, uuid.uuid4().hex, user_id, tier)
+        try:
+            await asyncio.to_thread(self._enqueue, ticket)
+        except AdmissionRejected as e:
+            REJECTED.inc(reason=e.reason)
+            raise
+        return ticket
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _transaction(self, fn, *args):
+        with self._lock:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = fn(conn, time.time(), *args)
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+            return result
+
+    def _enqueue(self, ticket):
+        self._transaction(self._enqueue_in, ticket)
+
+    def _enqueue_in(self, conn, now, ticket):
+        self._purge(conn, now)
+        tier = ticket.tier
+
+        row = conn.execute('SELECT tokens, updated_at FROM buckets WHERE user_id = ?', (ticket.user_id,)).fetchone()
+        tokens = tier.burst if row is None else min(tier.burst, row[0] + (now - row[1]) * tier.rate)
+        if tokens < 1:
+            retry_after = (1 - tokens) / tier.rate if tier.rate else None
+            raise AdmissionRejected('rate_limited', 'Too many requests, please slow down', retry_after)
+
+        active = conn.execute(
+            'SELECT (SELECT COUNT(*) FROM slots WHERE user_id = ?) + (SELECT COUNT(*) FROM waiters WHERE user_id = ?)',
+            (ticket.user_id, ticket.user_id),
+        ).fetchone()[0]
+        if active >= tier.concurrent:
+            raise AdmissionRejected('user_concurrency', 'Too many requests in progress, please wait for one to finish')
+
+        waiting = conn.execute('SELECT COUNT(*) FROM waiters').fetchone()[0]
+        free_slots = max(0, self.max_running - conn.execute('SELECT COUNT(*) FROM slots').fetchone()[0])
+        if waiting - free_slots >= self.queue_size:
+            raise AdmissionRejected('queue_full', 'The server is busy, please try again shortly', POLL_INTERVAL * 4)
+
+        conn.execute(
+            'INSERT INTO buckets (user_id, tokens, updated_at) VALUES (?, ?, ?) '
+            'ON CONFLICT(user_id) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at',
+            (ticket.user_id, tokens - 1, now),
+        )
+        if waiting == 0 and free_slots:
+            # Nobody is waiting: take a run slot now and skip the queue
+            conn.execute(
+                'INSERT INTO slots (id, user_id, expires_at) VALUES (?, ?, ?)',
+                (ticket.id, ticket.user_id, now + self.slot_lease),
+            )
+            ticket.running = True
+        else:
+            conn.execute('INSERT INTO waiters (id, user_id, heartbeat) VALUES (?, ?, ?)', (ticket.id, ticket.user_id, now))
+
+    def _try_start(self, ticket):
+        """Return 0 once the ticket holds a run slot, else its queue position"""
+        return self._transaction(self._try_start_in, ticket)
+
+    def _try_start_in(self, conn, now, ticket):
+        self._purge(conn, now)
+        row = conn.execute('SELECT seq FROM waiters WHERE id = ?', (ticket.id,)).fetchone()
+        if row is None:
+            # Purged as stale (e.g. the event loop was blocked); rejoin at the back
+            conn.execute('INSERT INTO waiters (id, user_id, heartbeat) VALUES (?, ?, ?)', (ticket.id, ticket.user_id, now))
+            row = conn.execute('SELECT seq FROM waiters WHERE id = ?', (ticket.id,)).fetchone()
+        conn.execute('UPDATE waiters SET heartbeat = ? WHERE id = ?', (now, ticket.id))
+
+        ahead = conn.execute('SELECT COUNT(*) FROM waiters WHERE seq < ?', (row[0],)).fetchone()[0]
+        running = conn.execute('SELECT COUNT(*) FROM slots').fetchone()[0]
+        if ahead == 0 and running < self.max_running:
+            conn.execute('DELETE FROM waiters WHERE id = ?', (ticket.id,))
+            conn.execute(
+                'INSERT INTO slots (id, user_id, expires_at) VALUES (?, ?, ?)',
+                (ticket.id, ticket.user_id, now + self.slot_lease),
+            )
+            return 0
+        return ahead + 1
+
+    def _release(self, ticket):
+        def release(conn, now):
+            conn.execute('DELETE FROM waiters WHERE id = ?', (ticket.id,))
+            conn.execute('DELETE FROM slots WHERE id = ?', (ticket.id,))
+        self._transaction(release)
+
+    def _purge(self, conn, now):
+        conn.execute('DELETE FROM slots WHERE expires_at < ?', (now,))
+        conn.execute('DELETE FROM waiters WHERE heartbeat < ?', (now - WAITER_STALE_SECONDS,))
+
+
+admission = Admission()
@@ -0,0 +1,201 @@
+import os
+import time
+import asyncio
+import datetime
+from collections import OrderedDict
+from zoneinfo import ZoneInfo
+from dateutil.rrule import rrulestr
+from googleapiclient.errors import HttpError
+from google_io import google_io
+
+AVAILABILITY_SYNC_INTERVAL = float(os.getenv('AVAILABILITY_SYNC_INTERVAL', '60'))
+AVAILABILITY_LOOKBACK_DAYS = int(os.getenv('AVAILABILITY_LOOKBACK_DAYS', '1'))
+AVAILABILITY_INDEX_SIZE = int(os.getenv('AVAILABILITY_INDEX_SIZE', '256'))
+
+# Occurrences of a new recurring event checked for conflicts
+MAX_CHECKED_OCCURRENCES = 50
+
+
+def parse_datetime(value, tz):
+    """Parse an ISO 8601 string, treating naive values as local time in `tz`"""
+    parsed = datetime.datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=tz)
+    return parsed
+
+
+def parse_event_time(value, tz):
+    """Parse a Calendar API start/end object ({'dateTime'} or all-day {'date'})"""
+    tz = ZoneInfo(value['timeZone']) if value.get('timeZone') else tz
+    if 'dateTime' in value:
+        return parse_datetime(value['dateTime'], tz)
+    return datetime.datetime.combine(datetime.date.fromisoformat(value['date']), datetime.time(), tz)
+
+
+def expand(start, end, recurrence, window_start, window_end, exdates=(), limit=None):
+    """Yield (start, end) occurrences of an event that overlap the window"""
+    duration = end - start
+    if not recurrence:
+        if start < window_end and end > window_start:
+            yield start, end
+        return
+
+    try:
+        rule = rrulestr('\n'.join(recurrence), dtstart=start, forceset=True)
+        occurrences = rule.between(window_start - duration, window_end, inc=True)
+    except (ValueError, TypeError) as e:
+        print(f"Skipping unparseable recurrence {recurrence}: {e}")
+        occurrences = [start] if start < window_end and end > window_start else []
+
+    for count, occurrence in enumerate(o for o in occurrences if o not in exdates):
+        if limit is not None and count >= limit:
+            break
+        if occurrence + duration > window_start:
+            yield occurrence, occurrence + duration
+
+
+class IndexedEvent:
+    def __init__(self, event_id, summary, start, end, recurrence):
+        self.event_id = event_id
+        self.summary = summary
+        self.start = start
+        self.end = end
+        self.recurrence = recurrence
+
+
+class AvailabilityIndex:
+    """Busy blocks of one user's primary calendar, kept in memory.
+
+    The index is filled by a full events.list and then kept current with
+    incremental syncs using the returned syncToken, so queries over weeks of
+    events run locally. Recurring events are stored once with their RRULEs
+    and expanded per query; moved or cancelled instances are excluded via
+    their original start time.
+    """
+
+    def __init__(self):
+        self.events = {}
+        self.exdates = {}
+        self.sync_token = None
+        self.synced_at = 0.0
+        self.time_zone = ZoneInfo('UTC')
+        self.lock = asyncio.Lock()
+
+    async def sync(self, service, force=False):
+        async with self.lock:
+            if not force and time.monotonic() - self.synced_at < AVAILABILITY_SYNC_INTERVAL:
+                return
+            try:
+                await self._sync(service)
+            except HttpError as e:
+                if e.resp.status != 410:
+                    raise
+                # Sync token expired: start over with a full sync
+                self.sync_token = None
+                await self._sync(service)
+            self.synced_at = time.monotonic()
+
+    async def _sync(self, service):
+        params = {'calendarId': 'primary', 'maxResults': 250}
+        if self.sync_token:
+            params['syncToken'] = self.sync_token
+        else:
+            self.events.clear()
+            self.exdates.clear()
+            lookback = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=AVAILABILITY_LOOKBACK_DAYS)
+            params['timeMin'] = lookback.isoformat()
+
+        page_token = None
+        while True:
+            response = await google_io.execute(service.events().list(pageToken=page_token, **params))
+            if response.get('timeZone'):
+                self.time_zone = ZoneInfo(response['timeZone'])
+            for item in response.get('items', []):
+                self.apply(item)
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                self.sync_token = response.get('nextSyncToken')
+                break
+
+    def apply(self, item):
+        """Add, update or remove one event resource from the index"""
+        master_id = item.get('recurringEventId')
+        if master_id and item.get('originalStartTime'):
+            original = parse_event_time(item['originalStartTime'], self.time_zone)
+            self.exdates.setdefault(master_id, set()).add(original)
+
+        if item.get('status') == 'cancelled' or item.get('transparency') == 'transparent':
+            self.events.pop(item['id'], None)
+            return
+        if 'start' not in item or 'end' not in item:
+            return
+
+        self.events[item['id']] = IndexedEvent(
+            item['id'],
+            item.get('summary', '(busy)'),
+            parse_event_time(item['start'], self.time_zone),
+            parse_event_time(item['end'], self.time_zone),
+            item.get('recurrence'),
+        )
+
+    def busy(self, window_start, window_end):
+        """Return (start, end, summary) for every busy occurrence overlapping the window"""
+        blocks = []
+        for event in self.events.values():
+            exdates = self.exdates.get(event.event_id, ())
+            for start, end in expand(event.start, event.end, event.recurrence, window_start, window_end, exdates):
+                blocks.append((start, end, event.summary))
+        blocks.sort(key=lambda b: b[0])
+        return blocks
+
+
+class AvailabilityIndexes:
+    """Bounded LRU of per-user availability indexes"""
+
+    def __init__(self, max_size=AVAILABILITY_INDEX_SIZE):
+        self.max_size = max_size
+        self._indexes = OrderedDict()
+
+    def get(self, user_id):
+        index = self._indexes.get(user_id)
+        if index is None:
+            index = self._indexes[user_id] = AvailabilityIndex()
+        self._indexes.move_to_end(user_id)
+        while len(self._indexes) > self.max_size:
+            self._indexes.popitem(last=False)
+        return index
+
+
+def merge_intervals(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def free_windows(busy, window_start, window_end, duration, tz, day_start, day_end):
+    """Yield free (start, end) windows of at least `duration` inside working hours"""
+    busy = merge_intervals(busy)
+    day = window_start.astimezone(tz).date()
+    while True:
+        work_start = datetime.datetime.combine(day, day_start, tz)
+        work_end = datetime.datetime.combine(day, day_end, tz)
+        if work_start >= window_end:
+            return
+        cursor = max(work_start, window_start)
+        limit = min(work_end, window_end)
+        for start, end in busy:
+            if end <= cursor or start >= limit:
+                continue
+            if start - cursor >= duration:
+                yield cursor, start
+            cursor = max(cursor, end)
+        if limit - cursor >= duration:
+            yield cursor, limit
+        day += datetime.timedelta(days=1)
+
+
+availability_indexes = AvailabilityIndexes()
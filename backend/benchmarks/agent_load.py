@@ -0,0 +1,293 @@
+"""Offline load test for the /agent endpoint.
+
+Runs workflow_api under uvicorn on localhost with Firestore, Gmail and
+Calendar replaced by in-memory fakes (see fakes.py) and Gemini replaced by a
+pydantic-ai FunctionModel with configurable latency, then drives concurrent
+SSE clients against it. Run from the backend directory:
+
+    python benchmarks/agent_load.py --clients 50 --turns 3 --scenario mixed
+
+Reports p50/p95/p99 time to first event, time to first text delta and total
+stream time, plus requests per second and memory per connection. With
+--max-p95-ttfe-ms / --max-p95-total-ms / --min-rps it exits non-zero when a
+threshold is missed, so it can run in CI.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SECRET_KEY', 'offline-benchmark')
+os.environ.setdefault('GOOGLE_API_KEY', 'offline-benchmark')
+os.environ.setdefault('PYDANTIC_AI_NO_BANNER', '1')
+
+import httpx
+import uvicorn
+from pydantic_ai.messages import ToolReturnPart
+from pydantic_ai.models.function import FunctionModel, DeltaToolCall
+
+import fakes
+
+SCENARIOS = ('chat', 'email', 'calendar', 'combined')
+
+PROMPTS = {
+    'chat': 'What is 12 * 7?',
+    'email': 'Send an email to alice@example.com saying the report is ready',
+    'calendar': 'Schedule a sync with bob@example.com tomorrow at 10am',
+    'combined': 'Schedule a sync with bob@example.com tomorrow at 10am and email alice@example.com about it',
+}
+
+SEND_MESSAGE = ('send_message', {
+    'email_to': 'alice@example.com',
+    'email_origin': 'me@example.com',
+    'subject': 'Report',
+    'content': '<p>The report is ready.</p>',
+})
+CREATE_EVENT = ('create_event', {
+    'title': 'Sync',
+    'description': 'Weekly sync',
+    'start_date': '2030-01-01T10:00:00+07:00',
+    'end_date': '2030-01-01T11:00:00+07:00',
+    'allow_conflicts': True,
+})
+
+# Tool calls the fake model makes, all in one response, per scenario
+TOOL_CALLS = {
+    'email': [SEND_MESSAGE],
+    'calendar': [CREATE_EVENT],
+    'combined': [CREATE_EVENT, SEND_MESSAGE],
+}
+
+
+class Sample:
+    def __init__(self, first_event, first_delta, total, error=None):
+        self.first_event = first_event
+        self.first_delta = first_delta
+        self.total = total
+        self.error = error
+
+
+def make_model(first_token_latency, token_delay, tokens):
+    """A streaming model that makes the tool calls of the prompt's scenario once, then answers"""
+
+    async def stream(messages, info):
+        await asyncio.sleep(first_token_latency)
+        prompt = next(
+            (p.content for m in reversed(messages) for p in m.parts if p.part_kind == 'user-prompt'),
+            '',
+        )
+        scenario = next((s for s, text in PROMPTS.items() if text == prompt), 'chat')
+        called = any(isinstance(p, ToolReturnPart) for p in messages[-1].parts)
+        if scenario in TOOL_CALLS and not called:
+            yield {
+                i: DeltaToolCall(name=name, json_args=json.dumps(args), tool_call_id=uuid.uuid4().hex)
+                for i, (name, args) in enumerate(TOOL_CALLS[scenario])
+            }
+            return
+        for i in range(tokens):
+            if i:
+                await asyncio.sleep(token_delay)
+            yield f'token{i} '
+
+    return FunctionModel(stream_function=stream)
+
+
+def current_rss():
+    """Resident set size in bytes, or None where /proc is unavailable"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+async def sample_memory(peak, stop):
+    while not stop.is_set():
+        rss = current_rss()
+        if rss is not None:
+            peak[0] = max(peak[0], rss)
+        await asyncio.sleep(0.02)
+
+
+async def run_client(client, client_id, turns, scenarios, samples):
+    chat_id = f'bench-{client_id}-{uuid.uuid4().hex[:8]}'
+    for turn in range(turns):
+        scenario = scenarios[(client_id + turn) % len(scenarios)]
+        body = {'prompt': PROMPTS[scenario], 'chat_id': chat_id, 'user_id': f'user-{client_id}'}
+        start = time.perf_counter()
+        first_event = first_delta = None
+        error = 'stream ended without done'
+        try:
+            async with client.stream('POST', '/agent', json=body) as response:
+                if response.status_code != 200:
+                    error = f'HTTP {response.status_code}'
+                else:
+                    async for line in response.aiter_lines():
+                        if not line.startswith('data: '):
+                            continue
+                        elapsed = time.perf_counter() - start
+                        event = json.loads(line[6:])
+                        if first_event is None:
+                            first_event = elapsed
+                        if event['type'] in ('delta', 'content') and first_delta is None:
+                            first_delta = elapsed
+                        if event['type'] == 'error':
+                            error = event.get('message', 'error event')
+                            break
+                        if event['type'] == 'done':
+                            error = None
+                            break
+        except httpx.HTTPError as e:
+            error = repr(e)
+        samples.append(Sample(first_event, first_delta, time.perf_counter() - start, error))
+
+
+def percentiles(values):
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None}
+    if len(values) == 1:
+        return {'p50': values[0], 'p95': values[0], 'p99': values[0]}
+    cuts = statistics.quantiles(values, n=100, method='inclusive')
+    return {'p50': cuts[49], 'p95': cuts[94], 'p99': cuts[98]}
+
+
+async def start_server(app):
+    config = uvicorn.Config(app, host='127.0.0.1', port=0, log_level='warning', lifespan='on')
+    server = uvicorn.Server(config)
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()
+        await asyncio.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    return server, task, f'http://127.0.0.1:{port}'
+
+
+async def run(args):
+    fakes.install(google_latency=args.google_latency_ms / 1000)
+    # Admission control is off unless a run-slot cap is given; its state goes to a throwaway file
+    os.environ['ADMISSION_MAX_RUNNING'] = str(args.max_running)
+    os.environ['ADMISSION_QUEUE_SIZE'] = str(args.queue_size)
+    os.environ.setdefault('ADMISSION_DB_PATH', os.path.join(tempfile.mkdtemp(), 'admission.db'))
+
+    import workflow_api
+    import workflow_agent
+
+    scenarios = SCENARIOS if args.scenario == 'mixed' else (args.scenario,)
+    model = make_model(args.model_latency_ms / 1000, args.token_delay_ms / 1000, args.tokens)
+    chat_latency_ms = args.model_latency_ms if args.chat_model_latency_ms is None else args.chat_model_latency_ms
+    chat_model = make_model(chat_latency_ms / 1000, args.token_delay_ms / 1000, args.tokens)
+    limits = httpx.Limits(max_connections=args.clients, max_keepalive_connections=args.clients)
+
+    # The override is a context variable, so the server task must start inside it
+    with workflow_agent.agent.override(model=model), workflow_agent.chat_agent.override(model=chat_model):
+        server, server_task, base_url = await start_server(workflow_api.app)
+        try:
+            async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+                await run_client(client, -1, 1, scenarios, [])
+
+                baseline = current_rss() or 0
+                peak = [baseline]
+                stop = asyncio.Event()
+                sampler = asyncio.create_task(sample_memory(peak, stop))
+
+                samples = []
+                started = time.perf_counter()
+                await asyncio.gather(*[
+                    run_client(client, i, args.turns, scenarios, samples) for i in range(args.clients)
+                ])
+                wall = time.perf_counter() - started
+
+                stop.set()
+                await sampler
+        finally:
+            server.should_exit = True
+            await server_task
+
+    ok = [s for s in samples if s.error is None]
+    report = {
+        'clients': args.clients,
+        'turns': args.turns,
+        'scenario': args.scenario,
+        'requests': len(samples),
+        'errors': len(samples) - len(ok),
+        'requests_per_second': len(samples) / wall if wall else None,
+        'time_to_first_event_ms': {k: v and v * 1000 for k, v in percentiles([s.first_event for s in ok]).items()},
+        'time_to_first_delta_ms': {k: v and v * 1000 for k, v in percentiles([s.first_delta for s in ok if s.first_delta is not None]).items()},
+        'total_stream_ms': {k: v and v * 1000 for k, v in percentiles([s.total for s in ok]).items()},
+        'memory_per_connection_kib': (peak[0] - baseline) / args.clients / 1024 if baseline else None,
+        'sample_errors': sorted({s.error for s in samples if s.error})[:5],
+    }
+    return report
+
+
+def print_report(report):
+    print(f"requests          {report['requests']} ({report['errors']} errors) "
+          f"from {report['clients']} clients x {report['turns']} turns, scenario={report['scenario']}")
+    print(f"throughput        {report['requests_per_second']:.1f} req/s")
+    for key, label in (('time_to_first_event_ms', 'first event'),
+                       ('time_to_first_delta_ms', 'first delta'),
+                       ('total_stream_ms', 'total stream')):
+        p = report[key]
+        if p['p50'] is None:
+            print(f"{label:<17} n/a")
+        else:
+            print(f"{label:<17} p50 {p['p50']:8.1f} ms   p95 {p['p95']:8.1f} ms   p99 {p['p99']:8.1f} ms")
+    if report['memory_per_connection_kib'] is not None:
+        print(f"memory            {report['memory_per_connection_kib']:.1f} KiB per connection (peak RSS growth)")
+    for error in report['sample_errors']:
+        print(f"error             {error}")
+
+
+def check_thresholds(report, args):
+    failures = []
+    if report['errors']:
+        failures.append(f"{report['errors']} requests failed")
+    if args.max_p95_ttfe_ms is not None and (report['time_to_first_event_ms']['p95'] or 0) > args.max_p95_ttfe_ms:
+        failures.append(f"p95 time to first event above {args.max_p95_ttfe_ms} ms")
+    if args.max_p95_total_ms is not None and (report['total_stream_ms']['p95'] or 0) > args.max_p95_total_ms:
+        failures.append(f"p95 total stream time above {args.max_p95_total_ms} ms")
+    if args.min_rps is not None and report['requests_per_second'] < args.min_rps:
+        failures.append(f"throughput below {args.min_rps} req/s")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=20, help='concurrent SSE clients')
+    parser.add_argument('--turns', type=int, default=3, help='sequential turns per client, in one chat')
+    parser.add_argument('--scenario', choices=SCENARIOS + ('mixed',), default='mixed')
+    parser.add_argument('--model-latency-ms', type=float, default=200, help='delay before each model response starts')
+    parser.add_argument('--chat-model-latency-ms', type=float, help='the same for the fast model that plain chat turns are routed to (default: --model-latency-ms)')
+    parser.add_argument('--token-delay-ms', type=float, default=5, help='delay between streamed tokens')
+    parser.add_argument('--tokens', type=int, default=50, help='tokens per model answer')
+    parser.add_argument('--google-latency-ms', type=float, default=100, help='latency of each fake Gmail/Calendar call')
+    parser.add_argument('--max-running', type=int, default=0, help='admission control run slots (0 disables admission control)')
+    parser.add_argument('--queue-size', type=int, default=64, help='admission control wait queue size')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--json', help='also write the report to this file')
+    parser.add_argument('--max-p95-ttfe-ms', type=float)
+    parser.add_argument('--max-p95-total-ms', type=float)
+    parser.add_argument('--min-rps', type=float)
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    failures = check_thresholds(report, args)
+    for failure in failures:
+        print(f"FAIL              {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
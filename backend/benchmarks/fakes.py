@@ -0,0 +1,267 @@
+"""In-memory stand-ins for Firestore and the Gmail/Calendar clients.
+
+They implement only what the backend uses, so the FastAPI app can run
+without network access. `install()` must run before the app's lifespan
+starts, because that is when the shared Firestore client is created.
+"""
+import copy
+import time
+import uuid
+import operator
+from google.api_core.exceptions import AlreadyExists
+
+OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+
+class FakeDocument:
+    def __init__(self, store, path):
+        self._store = store
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def collection(self, name):
+        return FakeQuery(self._store, f'{self.path}/{name}')
+
+    async def get(self, field_paths=None):
+        return FakeSnapshot(self, copy.deepcopy(self._store.get(self.path)))
+
+    async def set(self, data, merge=False):
+        if merge and self.path in self._store:
+            self._store[self.path].update(copy.deepcopy(data))
+        else:
+            self._store[self.path] = copy.deepcopy(data)
+
+    async def create(self, data):
+        if self.path in self._store:
+            raise AlreadyExists(f'Document already exists: {self.path}')
+        self._store[self.path] = copy.deepcopy(data)
+
+    async def update(self, data):
+        if self.path not in self._store:
+            raise KeyError(f'No document to update: {self.path}')
+        self._store[self.path].update(copy.deepcopy(data))
+
+    async def delete(self):
+        self._store.pop(self.path, None)
+
+
+class FakeQuery:
+    """A collection reference that also supports the query methods the backend uses"""
+
+    def __init__(self, store, path, filters=(), orders=(), limit=None, cursor=None, fields=None):
+        self._store = store
+        self.path = path
+        self._filters = filters
+        self._orders = orders
+        self._limit = limit
+        self._cursor = cursor
+        self._fields = fields
+
+    def _copy(self, **changes):
+        state = dict(filters=self._filters, orders=self._orders, limit=self._limit,
+                     cursor=self._cursor, fields=self._fields)
+        state.update(changes)
+        return FakeQuery(self._store, self.path, **state)
+
+    def document(self, document_id=None):
+        return FakeDocument(self._store, f'{self.path}/{document_id or uuid.uuid4().hex}')
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction='ASCENDING'):
+        return self._copy(orders=self._orders + ((field_path, str(direction).upper().endswith('DESCENDING')),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, values):
+        return self._copy(cursor=values)
+
+    def select(self, field_paths):
+        return self._copy(fields=list(field_paths))
+
+    async def stream(self):
+        for path, data in self._rows():
+            if self._fields is not None:
+                data = {k: v for k, v in data.items() if k in self._fields}
+            yield FakeSnapshot(FakeDocument(self._store, path), copy.deepcopy(data))
+
+    async def get(self):
+        return [snapshot async for snapshot in self.stream()]
+
+    def _rows(self):
+        rows = [
+            (path, data) for path, data in self._store.items()
+            if path.rsplit('/', 1)[0] == self.path
+            and all(f in data and OPERATORS[op](data[f], v) for f, op, v in self._filters)
+            # Like Firestore, ordering on a field skips documents without it
+            and all(f in data for f, _ in self._orders if f != '__name__')
+        ]
+        for field, descending in reversed(self._orders):
+            rows.sort(key=lambda row: self._value(row, field), reverse=descending)
+        if self._cursor is not None:
+            cursor = self._cursor if isinstance(self._cursor, dict) else self._cursor.to_dict()
+            key = tuple(cursor[f] for f, _ in self._orders)
+            rows = [row for row in rows if self._after(row, key)]
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        return rows
+
+    @staticmethod
+    def _value(row, field):
+        return row[0].rsplit('/', 1)[-1] if field == '__name__' else row[1].get(field)
+
+    def _after(self, row, key):
+        for (field, descending), value in zip(self._orders, key):
+            current = self._value(row, field)
+            if current == value:
+                continue
+            return current < value if descending else current > value
+        return False
+
+
+class FakeBatch:
+    def __init__(self):
+        self._writes = []
+        self._creates = []
+
+    def create(self, reference, data):
+        self._creates.append(reference)
+        self._writes.append(lambda: reference.create(data))
+
+    def set(self, reference, data, merge=False):
+        self._writes.append(lambda: reference.set(data, merge=merge))
+
+    def update(self, reference, data):
+        self._writes.append(lambda: reference.update(data))
+
+    async def commit(self):
+        # All or nothing, like Firestore: check creates before writing anything
+        for reference in self._creates:
+            if reference.path in reference._store:
+                raise AlreadyExists(f'Document already exists: {reference.path}')
+        for write in self._writes:
+            await write()
+
+
+class FakeFirestore:
+    """In-memory replacement for firestore_async.client()"""
+
+    def __init__(self):
+        self.store = {}
+
+    def collection(self, name):
+        return FakeQuery(self.store, name)
+
+    def batch(self):
+        return FakeBatch()
+
+    def close(self):
+        pass
+
+
+class FakeRequest:
+    """Stands in for a googleapiclient HttpRequest; execute() blocks like the real one"""
+
+    def __init__(self, response, latency):
+        self._response = response
+        self._latency = latency
+
+    def execute(self, num_retries=0, http=None):
+        time.sleep(self._latency)
+        return self._response
+
+    def next_chunk(self, http=None, num_retries=0):
+        return None, self.execute()
+
+
+class FakeGmailService:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def send(self, userId, body=None, media_body=None):
+        return FakeRequest({'id': uuid.uuid4().hex, 'threadId': uuid.uuid4().hex, 'labelIds': ['SENT']}, self.latency)
+
+
+class FakeCalendarService:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def events(self):
+        return self
+
+    def insert(self, calendarId, body):
+        event = dict(body, id=uuid.uuid4().hex, status='confirmed', htmlLink='https://calendar.example/event')
+        return FakeRequest(event, self.latency)
+
+    def list(self, **params):
+        return FakeRequest({'items': [], 'nextSyncToken': 'offline'}, self.latency)
+
+    def freebusy(self):
+        return self
+
+    def query(self, body):
+        return FakeRequest({'calendars': {}}, self.latency)
+
+
+def install(google_latency=0.0):
+    """Route Firebase and the Google tool clients to in-memory fakes.
+
+    Returns the FakeFirestore so callers can inspect what was written.
+    """
+    import firebase_admin
+    from firebase_admin import credentials, firestore_async
+
+    db = FakeFirestore()
+    credentials.Certificate = lambda *args, **kwargs: object()
+    firebase_admin.initialize_app = lambda *args, **kwargs: firebase_admin._apps.setdefault('[DEFAULT]', object())
+    firestore_async.client = lambda *args, **kwargs: db
+
+    import email_tool
+    import calendar_tool
+
+    gmail = FakeGmailService(google_latency)
+    calendar = FakeCalendarService(google_latency)
+
+    async def get_gmail_service(user_id, *args, **kwargs):
+        return gmail
+
+    async def get_calendar_service(user_id, *args, **kwargs):
+        return calendar
+
+    email_tool.get_gmail_service = get_gmail_service
+    calendar_tool.get_calendar_service = get_calendar_service
+    return db
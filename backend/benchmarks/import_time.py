@@ -0,0 +1,140 @@
+"""Cold-start cost of the API server.
+
+Starts fresh Python processes that import workflow_api and run its lifespan
+hook with Firestore, Gmail and Calendar replaced by in-memory fakes (see
+fakes.py), and reports how long each took to import the app, to start
+serving and to finish the warm-up (`/ready`). One extra run under
+`python -X importtime` lists the slowest modules workflow_api imports. Run
+from the backend directory:
+
+    python benchmarks/import_time.py --runs 5 --warmup background
+
+With --max-import-ms / --max-ready-ms it exits non-zero when the median is
+above the threshold, so it can run in CI.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+import subprocess
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+
+def child():
+    """Measure one cold start in this (fresh) process and print it as JSON"""
+    started = time.perf_counter()
+    import workflow_api
+    imported = time.perf_counter()
+
+    import fakes
+    fakes.install()
+    patched = time.perf_counter()
+
+    async def start():
+        async with workflow_api.lifespan(workflow_api.app):
+            serving = time.perf_counter()
+            ready = await workflow_api.warmup.wait()
+            return serving, time.perf_counter(), ready
+
+    serving, warmed, ready = asyncio.run(start())
+    # Installing the fakes is benchmark overhead, not start-up cost
+    offset = patched - imported
+    print(json.dumps({
+        'import_ms': (imported - started) * 1000,
+        'serving_ms': (serving - started - offset) * 1000,
+        'ready_ms': (warmed - started - offset) * 1000,
+        'ready': ready,
+        'steps': workflow_api.warmup.steps,
+    }))
+
+
+def run_child(mode):
+    env = dict(os.environ, STARTUP_WARMUP=mode, TRACE_LOG='0')
+    started = time.perf_counter()
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), '--child'], cwd=BACKEND, env=env,
+                         capture_output=True, text=True)
+    if out.returncode:
+        raise RuntimeError(out.stderr.strip().splitlines()[-1] if out.stderr.strip() else 'child failed')
+    sample = json.loads(out.stdout.strip().splitlines()[-1])
+    sample['process_ms'] = (time.perf_counter() - started) * 1000
+    return sample
+
+
+def slowest_imports(top):
+    """Modules imported directly by workflow_api, by cumulative import time"""
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import workflow_api'], cwd=BACKEND,
+                         env=dict(os.environ, TRACE_LOG='0'), capture_output=True, text=True)
+    modules = []
+    for line in out.stderr.splitlines():
+        if not line.startswith('import time:') or '[us]' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Nested imports are indented two spaces per level under the module that triggered them
+        if name.startswith('   ') and not name.startswith('    '):
+            modules.append((int(cumulative) / 1000, name.strip()))
+    return sorted(modules, reverse=True)[:top]
+
+
+def median(samples, key):
+    return statistics.median(s[key] for s in samples)
+
+
+def main():
+    if '--child' in sys.argv:
+        return child()
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='fresh processes to start')
+    parser.add_argument('--warmup', choices=('blocking', 'background'), default='blocking', help='STARTUP_WARMUP mode')
+    parser.add_argument('--top', type=int, default=10, help='slowest imports to list (0 skips the importtime run)')
+    parser.add_argument('--json', help='also write the report to this file')
+    parser.add_argument('--max-import-ms', type=float)
+    parser.add_argument('--max-ready-ms', type=float)
+    args = parser.parse_args()
+
+    samples = [run_child(args.warmup) for _ in range(args.runs)]
+    report = {
+        'runs': args.runs,
+        'warmup': args.warmup,
+        'import_ms': median(samples, 'import_ms'),
+        'serving_ms': median(samples, 'serving_ms'),
+        'ready_ms': median(samples, 'ready_ms'),
+        'process_ms': median(samples, 'process_ms'),
+        'ready': all(s['ready'] for s in samples),
+        'steps_ms': {name: statistics.median(s['steps'][name]['seconds'] * 1000 for s in samples)
+                     for name in samples[0]['steps']},
+        'slowest_imports_ms': slowest_imports(args.top) if args.top else [],
+    }
+
+    print(f"runs              {report['runs']} (STARTUP_WARMUP={report['warmup']}), medians:")
+    print(f"import            {report['import_ms']:8.1f} ms  import workflow_api")
+    print(f"serving           {report['serving_ms']:8.1f} ms  import + lifespan start")
+    print(f"ready             {report['ready_ms']:8.1f} ms  import + warm-up finished")
+    print(f"process           {report['process_ms']:8.1f} ms  whole child process, interpreter included")
+    for name, ms in report['steps_ms'].items():
+        print(f"  {name:<15} {ms:8.1f} ms")
+    for ms, name in report['slowest_imports_ms']:
+        print(f"import {name:<24} {ms:8.1f} ms cumulative")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    failures = []
+    if not report['ready']:
+        failures.append('warm-up did not finish')
+    if args.max_import_ms is not None and report['import_ms'] > args.max_import_ms:
+        failures.append(f"median import time above {args.max_import_ms} ms")
+    if args.max_ready_ms is not None and report['ready_ms'] > args.max_ready_ms:
+        failures.append(f"median time to ready above {args.max_ready_ms} ms")
+    for failure in failures:
+        print(f"FAIL              {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
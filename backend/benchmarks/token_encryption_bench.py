@@ -0,0 +1,70 @@
+"""Encrypt/decrypt throughput for TokenEncryption.
+
+Compares deriving the Fernet key on every call (the old behaviour) against the
+cached MultiFernet path. Run from the backend directory:
+
+    python benchmarks/token_encryption_bench.py --iterations 200
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.fernet import Fernet
+from token_encryption import TokenEncryption, derive_key
+
+SAMPLE_TOKEN = json.dumps({
+    "token": "ya29." + "a" * 180,
+    "refresh_token": "1//" + "b" * 100,
+    "token_uri": "https://oauth2.googleapis.com/token",
+    "client_id": "1234567890-example.apps.googleusercontent.com",
+    "client_secret": "example-secret",
+    "scopes": ["https://www.googleapis.com/auth/gmail.send"],
+    "expiry": "2025-09-13T09:07:55.163768Z",
+})
+
+
+def uncached_roundtrip(encryptor: TokenEncryption, token_json: str) -> str:
+    """Encrypt and decrypt while deriving the key each time, as before"""
+    derive_key.cache_clear()
+    f = Fernet(derive_key(encryptor.password, encryptor.salt))
+    encrypted = base64.urlsafe_b64encode(f.encrypt(token_json.encode())).decode()
+    derive_key.cache_clear()
+    f = Fernet(derive_key(encryptor.password, encryptor.salt))
+    return f.decrypt(base64.urlsafe_b64decode(encrypted.encode())).decode()
+
+
+def cached_roundtrip(encryptor: TokenEncryption, token_json: str) -> str:
+    return encryptor.decrypt_token(encryptor.encrypt_token(token_json))
+
+
+def measure(label, fn, encryptor, iterations):
+    fn(encryptor, SAMPLE_TOKEN)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        assert fn(encryptor, SAMPLE_TOKEN) == SAMPLE_TOKEN
+    elapsed = time.perf_counter() - start
+    per_call = elapsed / iterations * 1000
+    print(f"{label:<10} {iterations / elapsed:>12.1f} roundtrips/s {per_call:>10.3f} ms/roundtrip")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    encryptor = TokenEncryption()
+    before = measure('before', uncached_roundtrip, encryptor, max(1, args.iterations // 10))
+    before_per_call = before / max(1, args.iterations // 10)
+    after = measure('after', cached_roundtrip, encryptor, args.iterations)
+    after_per_call = after / args.iterations
+    print(f"speedup    {before_per_call / after_per_call:>12.1f}x")
+
+
+if __name__ == '__main__':
+    main()
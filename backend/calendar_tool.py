@@ -1,25 +1,30 @@
 import os
 import json
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+import hashlib
+import datetime
 from googleapiclient.errors import HttpError
-import firebase_admin
-from firebase_admin import credentials, firestore_async
+from functools import partial
 from token_encryption import token_encryptor
+from service_cache import CachedService, service_cache, is_auth_error
+from google_io import google_io
+from discovery_cache import discovery_cache
+from firestore_client import firestore_client
+from telemetry import span
+from date_resolver import zone, iana_name
+from availability import availability_indexes, parse_datetime, expand, free_windows, MAX_CHECKED_OCCURRENCES
 
 SCOPES = ["https://www.googleapis.com/auth/calendar"]
 
 
-async def get_calendar_service(user_id):
-    """Get authenticated Calendar service using OAuth 2.0"""
+async def get_calendar_service(user_id, db=None):
+    """Get authenticated Calendar service using OAuth 2.0, reusing the cached client while its token is valid"""
+    return await service_cache.get_or_load(user_id, 'calendar', partial(_load_calendar_service, db=db or firestore_client.db))
+
+async def _load_calendar_service(user_id, cached, db):
+    """Load Calendar credentials from Firestore and build the service"""
+    # Imported here so the API server starts without loading google-auth
+    from google.oauth2.credentials import Credentials
     try:
-        if not firebase_admin._apps:
-            cred = credentials.Certificate("serviceAccountKey.json")
-            firebase_admin.initialize_app(cred)
-        
-        db = firestore_async.client()
         services_database = db.collection('services')
         
         user_doc = await services_database.document(user_id).get()
@@ -27,21 +32,28 @@ async def get_calendar_service(user_id):
             encrypted_token = user_doc.to_dict().get('token_calendar')
             if encrypted_token:
                 try:
+                    if cached and cached.token == encrypted_token and cached.creds.valid:
+                        return cached.touch()
+
                     token_data = token_encryptor.decrypt_token(encrypted_token)
                     creds = Credentials.from_authorized_user_info(json.loads(token_data), SCOPES)
                     if creds and creds.valid:
-                        return build("calendar", "v3", credentials=creds)
+                        service = await google_io.run(discovery_cache.build, "calendar", "v3", credentials=creds)
+                        return CachedService(service, creds, encrypted_token)
                     elif creds and creds.expired and creds.refresh_token:
-                        creds.refresh(Request())
+                        with span('token_refresh', service='calendar'):
+                            await google_io.refresh(creds)
                         encrypted_updated_token = token_encryptor.encrypt_token(creds.to_json())
                         await services_database.document(user_id).update({
                             'token_calendar': encrypted_updated_token
                         })
-                        return build("calendar", "v3", credentials=creds)
+                        service = await google_io.run(discovery_cache.build, "calendar", "v3", credentials=creds)
+                        return CachedService(service, creds, encrypted_updated_token)
                 except Exception as e:
                     print(f"Error decrypting Calendar token: {e}")
         
         if os.path.exists("credentials.json"):
+            from google_auth_oauthlib.flow import InstalledAppFlow
             flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
             creds = flow.run_local_server(port=8001)
             
@@ -55,18 +67,97 @@ async def get_calendar_service(user_id):
                     'token_calendar': encrypted_token
                 })
             
-            return build("calendar", "v3", credentials=creds)
+            service = await google_io.run(discovery_cache.build, "calendar", "v3", credentials=creds)
+            return CachedService(service, creds, encrypted_token)
         else:
             raise Exception(f"No credentials.json file found and no valid Calendar token for user {user_id}")
     except Exception as e:
         print(f"Error getting Calendar service: {e}")
         raise
 
-async def create_calendar_event(title, location, description, start_date, end_date, timezone, attendees, recurrence, user_id):
+async def find_free_slots(user_id, start_date, end_date, duration_minutes=30, timezone="Asia/Jakarta", attendees=None, day_start="09:00", day_end="17:00", max_slots=5, db=None):
+    """Find free windows between start_date and end_date within working hours
+    The user's own calendar is read from the local availability index;
+    attendees' calendars are checked with the freeBusy API.
+    Returns: list of {'start', 'end'} windows at least duration_minutes long
+    """
+    tz = zone(timezone)
+    window_start = parse_datetime(start_date, tz)
+    window_end = parse_datetime(end_date, tz)
+
+    with service_cache.invalidate_on_auth_error(user_id, 'calendar'):
+        service = await get_calendar_service(user_id, db)
+        index = availability_indexes.get(user_id)
+        await index.sync(service)
+
+        busy = [(start, end) for start, end, _ in index.busy(window_start, window_end)]
+        if attendees:
+            busy += await query_freebusy(service, attendees, window_start, window_end)
+
+    slots = []
+    windows = free_windows(
+        busy, window_start, window_end, datetime.timedelta(minutes=duration_minutes), tz,
+        datetime.time.fromisoformat(day_start), datetime.time.fromisoformat(day_end),
+    )
+    for start, end in windows:
+        slots.append({'start': start.astimezone(tz).isoformat(), 'end': end.astimezone(tz).isoformat()})
+        if len(slots) >= max_slots:
+            break
+    return slots
+
+async def query_freebusy(service, emails, window_start, window_end):
+    """Busy (start, end) blocks of other people's calendars"""
+    response = await google_io.execute(service.freebusy().query(body={
+        'timeMin': window_start.isoformat(),
+        'timeMax': window_end.isoformat(),
+        'items': [{'id': email} for email in emails],
+    }))
+    busy = []
+    for calendar in response.get('calendars', {}).values():
+        for block in calendar.get('busy', []):
+            busy.append((datetime.datetime.fromisoformat(block['start']), datetime.datetime.fromisoformat(block['end'])))
+    return busy
+
+async def check_conflicts(user_id, start_date, end_date, timezone="Asia/Jakarta", recurrence=None, db=None):
+    """Return existing events that overlap a proposed event (every occurrence if recurring)"""
+    tz = zone(timezone)
+    start = parse_datetime(start_date, tz)
+    end = parse_datetime(end_date, tz)
+
+    with service_cache.invalidate_on_auth_error(user_id, 'calendar'):
+        service = await get_calendar_service(user_id, db)
+        index = availability_indexes.get(user_id)
+        await index.sync(service)
+
+    horizon = end + datetime.timedelta(days=365) if recurrence else end
+    occurrences = list(expand(start, end, [recurrence] if recurrence else None, start, horizon, limit=MAX_CHECKED_OCCURRENCES))
+    if not occurrences:
+        return []
+
+    conflicts = []
+    for busy_start, busy_end, summary in index.busy(occurrences[0][0], occurrences[-1][1]):
+        if any(busy_start < o_end and busy_end > o_start for o_start, o_end in occurrences):
+            conflicts.append({'summary': summary, 'start': busy_start.isoformat(), 'end': busy_end.isoformat()})
+    return conflicts
+
+def event_id_for(key):
+    """A Calendar event id derived from an idempotency key (base32hex, 5-1024 chars)"""
+    return hashlib.sha1(key.encode()).hexdigest()
+
+async def create_calendar_event(title, location, description, start_date, end_date, timezone, attendees, recurrence, user_id, allow_conflicts=True, db=None, event_id=None):
     """Creates a Google Calendar
+    When allow_conflicts is False and the event overlaps existing ones, nothing is
+    created and {'status': 'conflict', 'conflicts': [...]} is returned instead
+    With an `event_id` the insert is idempotent: if an earlier attempt already
+    created the event, Google answers 409 and that event is returned.
     """
     try:
-        service = await get_calendar_service(user_id)
+        if not allow_conflicts:
+            conflicts = await check_conflicts(user_id, start_date, end_date, timezone, recurrence, db=db)
+            if conflicts:
+                return {'status': 'conflict', 'conflicts': conflicts}
+        
+        service = await get_calendar_service(user_id, db)
         
         event = {
           'summary': title,
@@ -80,9 +171,7 @@ async def create_calendar_event(title, location, description, start_date, end_da
             'dateTime': end_date,
             'timeZone': timezone
           },
-          'recurrence': [
-            recurrence
-          ],
+          'recurrence': [recurrence] if recurrence else [],
           'attendees': [
             {'email': x} for x in attendees
           ],
@@ -94,10 +183,23 @@ async def create_calendar_event(title, location, description, start_date, end_da
             ],
           },
         }
+        if not iana_name(timezone):
+            # Google only takes zone names; the dateTime values carry the fixed offset
+            del event['start']['timeZone'], event['end']['timeZone']
+        if event_id:
+            event['id'] = event_id
 
-        event = service.events().insert(calendarId='primary', body=event).execute()
+        try:
+            event = await google_io.execute(service.events().insert(calendarId='primary', body=event))
+        except HttpError as err:
+            if not event_id or err.resp.status != 409:
+                raise
+            event = await google_io.execute(service.events().get(calendarId='primary', eventId=event_id))
+        availability_indexes.get(user_id).apply(event)
         print( 'Event created: %s' % (event.get('htmlLink')))
     except HttpError as err:
+        if is_auth_error(err):
+            service_cache.invalidate(user_id, 'calendar')
         raise err
 
     return event
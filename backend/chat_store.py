@@ -0,0 +1,378 @@
+import os
+import json
+import time
+import base64
+import random
+import asyncio
+from collections import OrderedDict
+from datetime import datetime, timezone
+from telemetry import registry, span
+
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '50'))
+HISTORY_CACHE_SIZE = int(os.getenv('HISTORY_CACHE_SIZE', '512'))
+# Write each turn's messages in the background instead of before the answer is sent.
+# Off by default: queued turns live in one process, so only enable it when a
+# chat's requests always reach the same worker
+HISTORY_WRITE_BEHIND = os.getenv('HISTORY_WRITE_BEHIND', '0') == '1'
+# Seconds the flusher waits after a new turn so turns arriving together share a write
+HISTORY_FLUSH_DELAY = float(os.getenv('HISTORY_FLUSH_DELAY', '0.05'))
+HISTORY_FLUSH_CONCURRENCY = int(os.getenv('HISTORY_FLUSH_CONCURRENCY', '8'))
+HISTORY_FLUSH_MAX_BACKOFF = float(os.getenv('HISTORY_FLUSH_MAX_BACKOFF', '60'))
+# Failed writes of a chat's queued turns before they are dropped
+HISTORY_FLUSH_MAX_ATTEMPTS = int(os.getenv('HISTORY_FLUSH_MAX_ATTEMPTS', '8'))
+# Largest chunk written; Firestore documents are limited to 1 MiB
+HISTORY_CHUNK_MAX_BYTES = int(os.getenv('HISTORY_CHUNK_MAX_BYTES', str(900 * 1024)))
+# Seconds shutdown waits for pending history to be written
+HISTORY_FLUSH_TIMEOUT = float(os.getenv('HISTORY_FLUSH_TIMEOUT', '10'))
+
+PENDING_CHATS = registry.gauge('history_pending_chats', 'Chats with history not yet written to Firestore')
+FLUSHES = registry.counter('history_flushes_total', 'Write-behind history flushes by result', ['result'])
+LOST_TURNS = registry.counter('history_lost_turns_total', 'Turns dropped because their history could not be written')
+COALESCED_TURNS = registry.counter('history_coalesced_turns_total', 'Turns written in the same chunk as an earlier turn of their chat')
+
+CHUNK_COLLECTION = 'chunks'
+# Times a turn's chunks are written again after another turn took their seq
+APPEND_ATTEMPTS = 5
+# Chat document fields read when listing chats; never the messages themselves
+SUMMARY_FIELDS = ['title', 'created_at', 'updated_at']
+
+
+def messages_adapter():
+    # pydantic-ai loads with the agent during warm-up, not with the API module
+    from pydantic_ai.messages import ModelMessagesTypeAdapter
+    return ModelMessagesTypeAdapter
+
+
+def split_chunks(messages, max_bytes=HISTORY_CHUNK_MAX_BYTES):
+    """Encode messages as JSON arrays of at most `max_bytes` each, in order.
+
+    Raises ValueError for a message that is larger than `max_bytes` on its own.
+    """
+    adapter = messages_adapter()
+    chunks, group, size = [], [], 2
+    for message in messages:
+        encoded = adapter.dump_json([message])[1:-1]
+        if len(encoded) + 2 > max_bytes:
+            raise ValueError(f"A {message.kind} of {len(encoded)} bytes does not fit in a history chunk")
+        if group and size + 1 + len(encoded) > max_bytes:
+            chunks.append(b'[' + b','.join(group) + b']')
+            group, size = [], 2
+        size += len(encoded) + (1 if group else 0)
+        group.append(encoded)
+    if group or not chunks:
+        chunks.append(b'[' + b','.join(group) + b']')
+    return [chunk.decode() for chunk in chunks]
+
+
+def encode_cursor(chat):
+    value = json.dumps([chat['updated_at'].isoformat(), chat['id']])
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Return (updated_at, chat_id); raises ValueError for a malformed cursor"""
+    try:
+        updated_at, chat_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(updated_at), str(chat_id)
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+class ChatHistory:
+    def __init__(self, messages, seq):
+        self.messages = messages
+        self.seq = seq
+
+
+class PendingWrite:
+    """Turns of one chat waiting for the flusher"""
+
+    def __init__(self, history):
+        self.history = history  # full history, pending turns included
+        self.messages = []
+        self.turns = 0
+        self.fields = {}
+        self.attempts = 0
+        self.retry_at = 0.0
+
+
+class ChatStore:
+    """Append-only conversation storage.
+
+    Each turn's new messages are written as compact JSON chunks in the
+    `message_history/{chat_id}/chunks` sub-collection, numbered by `seq`;
+    a turn over HISTORY_CHUNK_MAX_BYTES takes several chunks. The
+    chat document only keeps summary fields and `chunk_count`. Decoded
+    history is cached per chat, so a turn only reads chunks it has not seen,
+    and chats written before chunking (a single `messages` string) are still
+    read as the first part of the history. Every write also maintains
+    `created_at` / `updated_at`, which `list_chats` sorts on.
+
+    With write-behind on, `save` queues a turn and returns at once. A
+    flusher task writes each chat's queued turns together, retrying failed
+    writes with backoff up to HISTORY_FLUSH_MAX_ATTEMPTS times before the
+    turns are dropped and counted in `history_lost_turns_total`, and `load`
+    serves a chat with queued turns from memory. Queued turns live in this process only, so the turns of a
+    chat should reach the same worker.
+    """
+
+    def __init__(self, db, collection_name='message_history', page_size=HISTORY_PAGE_SIZE, cache_size=HISTORY_CACHE_SIZE,
+                 write_behind=HISTORY_WRITE_BEHIND):
+        self.db = db
+        self.collection = db.collection(collection_name)
+        self.page_size = page_size
+        self.cache_size = cache_size
+        self.write_behind = write_behind
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._wakeup = None
+        self._flusher = None
+        self._stopping = False
+
+    def has_pending(self, chat_id):
+        return chat_id in self._pending
+
+    async def load(self, chat_id, chat_doc):
+        """Return the full message history of a chat given its snapshot"""
+        pending = self._pending.get(chat_id)
+        if pending:
+            return list(pending.history)
+        if not chat_doc.exists:
+            return []
+
+        data = chat_doc.to_dict()
+        chunk_count = data.get('chunk_count', 0)
+        cached = self._cache.get(chat_id)
+        if cached:
+            self._cache.move_to_end(chat_id)
+            if cached.seq == chunk_count:
+                return list(cached.messages)
+            messages, seq = list(cached.messages), cached.seq
+        else:
+            messages, seq = [], 0
+            legacy = data.get('messages')
+            if legacy:
+                with span('history_validate', legacy=True):
+                    messages = messages_adapter().validate_python(json.loads(legacy))
+
+        async for chunk_seq, chunk_messages in self.iter_chunks(chat_id, after_seq=seq):
+            messages.extend(chunk_messages)
+            seq = chunk_seq
+
+        self._remember(chat_id, ChatHistory(messages, seq))
+        return list(messages)
+
+    async def iter_chunks(self, chat_id, after_seq=0):
+        """Yield (seq, messages) for chunks after `after_seq`, one page of documents at a time"""
+        chunks = self.collection.document(chat_id).collection(CHUNK_COLLECTION)
+        while True:
+            query = chunks.order_by('seq').start_after({'seq': after_seq}).limit(self.page_size)
+            page = [doc async for doc in query.stream()]
+            for doc in page:
+                chunk = doc.to_dict()
+                after_seq = chunk['seq']
+                with span('history_validate'):
+                    messages = messages_adapter().validate_json(chunk['data'])
+                yield after_seq, messages
+            if len(page) < self.page_size:
+                break
+
+    async def append(self, chat_id, chat_doc, new_messages, fields=None):
+        """Write one turn's new messages as chunks and update the chat document.
+
+        Chunks are numbered after the snapshot's `chunk_count` and written
+        with `create`, so when a concurrent turn of the chat took those
+        numbers first the batch fails as a whole and is retried with a
+        fresh snapshot rather than overwriting that turn.
+        """
+        from google.api_core.exceptions import AlreadyExists
+        chat_ref = self.collection.document(chat_id)
+        chunks = split_chunks(new_messages)
+
+        for attempt in range(1, APPEND_ATTEMPTS + 1):
+            data = chat_doc.to_dict() if chat_doc.exists else {}
+            first = data.get('chunk_count', 0) + 1
+            batch = self.db.batch()
+            for seq, chunk in enumerate(chunks, first):
+                batch.create(chat_ref.collection(CHUNK_COLLECTION).document(f'{seq:08d}'), {'seq': seq, 'data': chunk})
+            now = datetime.now(timezone.utc)
+            summary = {'updated_at': now} if chat_doc.exists else {'created_at': now, 'updated_at': now}
+            batch.set(chat_ref, {**(fields or {}), **summary, 'chunk_count': seq}, merge=True)
+            try:
+                await batch.commit()
+                break
+            except AlreadyExists:
+                if attempt == APPEND_ATTEMPTS:
+                    raise
+                chat_doc = await chat_ref.get()
+
+        cached = self._cache.get(chat_id)
+        if cached and cached.seq == first - 1:
+            self._remember(chat_id, ChatHistory(cached.messages + list(new_messages), seq))
+        else:
+            self._cache.pop(chat_id, None)
+
+    async def save(self, chat_id, chat_doc, history, new_messages, fields=None):
+        """Store one turn; `history` is what `load` returned for it.
+
+        Queued for the flusher when write-behind is running, written
+        immediately otherwise. `fields` of the first queued turn win.
+        """
+        if self._flusher is None:
+            return await self.append(chat_id, chat_doc, new_messages, fields)
+        pending = self._pending.get(chat_id)
+        if pending is None:
+            pending = self._pending[chat_id] = PendingWrite(list(history))
+        pending.history.extend(new_messages)
+        pending.messages.extend(new_messages)
+        pending.turns += 1
+        pending.fields = {**(fields or {}), **pending.fields}
+        PENDING_CHATS.set(len(self._pending))
+        self._wakeup.set()
+
+    def start(self):
+        """Start the write-behind flusher; call from the event loop"""
+        if self.write_behind and self._flusher is None:
+            self._stopping = False
+            self._wakeup = asyncio.Event()
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self, timeout=HISTORY_FLUSH_TIMEOUT):
+        """Write what is still queued, waiting at most `timeout` seconds, and stop the flusher"""
+        if self._flusher is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(self._flusher, timeout)
+        except asyncio.TimeoutError:
+            print(f"History flusher stopped with {len(self._pending)} chats unwritten")
+        self._flusher = None
+
+    async def _flush_loop(self):
+        semaphore = asyncio.Semaphore(HISTORY_FLUSH_CONCURRENCY)
+
+        async def flush(chat_id):
+            async with semaphore:
+                await self._flush(chat_id)
+
+        while True:
+            now = time.monotonic()
+            due = [chat_id for chat_id, pending in self._pending.items()
+                   if pending.messages and (pending.retry_at <= now or self._stopping)]
+            if due:
+                await asyncio.gather(*[flush(chat_id) for chat_id in due])
+                PENDING_CHATS.set(len(self._pending))
+                continue
+            if self._stopping and not self._pending:
+                return
+            retry_at = min((pending.retry_at for pending in self._pending.values()), default=None)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), None if retry_at is None else max(0.0, retry_at - now))
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if HISTORY_FLUSH_DELAY and not self._stopping:
+                await asyncio.sleep(HISTORY_FLUSH_DELAY)
+
+    async def _flush(self, chat_id):
+        """Write every queued turn of a chat in one batch"""
+        pending = self._pending[chat_id]
+        messages, turns, fields = pending.messages, pending.turns, pending.fields
+        pending.messages, pending.turns, pending.fields = [], 0, {}
+        try:
+            with span('history_flush', turns=turns):
+                # Read afresh: chunk_count may have changed since the turn started
+                chat_doc = await self.collection.document(chat_id).get()
+                await self.append(chat_id, chat_doc, messages, fields)
+        except ValueError as e:
+            # Too large to ever be written
+            self._give_up(chat_id, turns, e)
+            return
+        except Exception as e:
+            pending.attempts += 1
+            if pending.attempts >= HISTORY_FLUSH_MAX_ATTEMPTS:
+                self._give_up(chat_id, turns, e)
+                return
+            pending.messages = messages + pending.messages
+            pending.turns += turns
+            pending.fields = {**pending.fields, **fields}
+            pending.retry_at = time.monotonic() + min(HISTORY_FLUSH_MAX_BACKOFF, 2 ** (pending.attempts - 1)) + random.random()
+            FLUSHES.inc(result='failed')
+            print(f"Writing history of chat {chat_id} failed (attempt {pending.attempts}), retrying: {e}")
+            return
+        FLUSHES.inc(result='ok')
+        COALESCED_TURNS.inc(turns - 1)
+        pending.attempts = 0
+        pending.retry_at = 0.0
+        if not pending.messages:
+            del self._pending[chat_id]
+
+    def _give_up(self, chat_id, turns, error):
+        """Drop a chat's queued turns, including any queued during the failed write"""
+        pending = self._pending.pop(chat_id)
+        turns += pending.turns
+        self._cache.pop(chat_id, None)
+        FLUSHES.inc(result='gave_up')
+        LOST_TURNS.inc(turns)
+        print(f"Dropped {turns} unwritten turns of chat {chat_id} after {pending.attempts} failed writes: {error}")
+
+    async def list_chats(self, user_id, limit=20, cursor=None):
+        """Return (chats, next_cursor): a page of a user's chat summaries, most recently updated first.
+
+        Only SUMMARY_FIELDS are fetched, so the cost is the same for short and
+        long chats. Needs the composite index in firestore.indexes.json.
+        """
+        from google.cloud.firestore_v1.base_query import FieldFilter
+        query = (
+            self.collection.where(filter=FieldFilter('user_id', '==', user_id))
+            .order_by('updated_at', direction='DESCENDING')
+            .order_by('__name__', direction='DESCENDING')
+            .select(SUMMARY_FIELDS)
+            .limit(limit + 1)
+        )
+        if cursor:
+            updated_at, chat_id = decode_cursor(cursor)
+            query = query.start_after({'updated_at': updated_at, '__name__': chat_id})
+
+        docs = [doc async for doc in query.stream()]
+        chats = [{'id': doc.id, **doc.to_dict()} for doc in docs[:limit]]
+        next_cursor = encode_cursor(chats[-1]) if len(docs) > limit else None
+        return chats, next_cursor
+
+    async def backfill_timestamps(self):
+        """Give chats written before `updated_at` existed their timestamps, so they are listed.
+
+        Chat ids are creation times in milliseconds; other ids get the current time.
+        """
+        updated = 0
+        async for doc in self.collection.select(['created_at', 'updated_at']).stream():
+            data = doc.to_dict()
+            if data.get('updated_at'):
+                continue
+            created_at = data.get('created_at')
+            if created_at is None:
+                try:
+                    created_at = datetime.fromtimestamp(int(doc.id) / 1000, timezone.utc)
+                except (ValueError, OverflowError, OSError):
+                    created_at = datetime.now(timezone.utc)
+            await doc.reference.update({'created_at': created_at, 'updated_at': created_at})
+            updated += 1
+        return updated
+
+    def _remember(self, chat_id, history):
+        self._cache[chat_id] = history
+        self._cache.move_to_end(chat_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+
+if __name__ == '__main__':
+    import sys
+    import asyncio
+    from firestore_client import firestore_client
+
+    if sys.argv[1:] != ['backfill-timestamps']:
+        sys.exit('usage: python chat_store.py backfill-timestamps')
+    count = asyncio.run(ChatStore(firestore_client.db).backfill_timestamps())
+    print(f"Added created_at/updated_at to {count} chats")
@@ -0,0 +1,496 @@
+import os
+import re
+import datetime
+from functools import lru_cache
+from zoneinfo import ZoneInfo, available_timezones
+from dateutil.rrule import rrulestr
+
+DEFAULT_TIMEZONE = os.getenv('DEFAULT_TIMEZONE', 'Asia/Jakarta')
+DEFAULT_EVENT_MINUTES = int(os.getenv('DEFAULT_EVENT_MINUTES', '60'))
+
+# Days listed in the run instructions so the model can name dates without a tool call
+INSTRUCTION_DAYS = 7
+
+TIMEZONE_ALIASES = {
+    'wib': 'Asia/Jakarta',
+    'indonesia': 'Asia/Jakarta',
+    'jakarta': 'Asia/Jakarta',
+    'wita': 'Asia/Makassar',
+    'makassar': 'Asia/Makassar',
+    'bali': 'Asia/Makassar',
+    'wit': 'Asia/Jayapura',
+    'jayapura': 'Asia/Jayapura',
+    'et': 'America/New_York',
+    'est': 'America/New_York',
+    'edt': 'America/New_York',
+    'eastern': 'America/New_York',
+    'ct': 'America/Chicago',
+    'cst': 'America/Chicago',
+    'cdt': 'America/Chicago',
+    'central': 'America/Chicago',
+    'mt': 'America/Denver',
+    'mst': 'America/Denver',
+    'mdt': 'America/Denver',
+    'mountain': 'America/Denver',
+    'pt': 'America/Los_Angeles',
+    'pst': 'America/Los_Angeles',
+    'pdt': 'America/Los_Angeles',
+    'pacific': 'America/Los_Angeles',
+    'uk': 'Europe/London',
+    'bst': 'Europe/London',
+    'cet': 'Europe/Berlin',
+    'cest': 'Europe/Berlin',
+    'ist': 'Asia/Kolkata',
+    'india': 'Asia/Kolkata',
+    'sgt': 'Asia/Singapore',
+    'jst': 'Asia/Tokyo',
+    'aest': 'Australia/Sydney',
+    'utc': 'UTC',
+    'gmt': 'UTC',
+    'z': 'UTC',
+}
+
+WEEKDAYS = {name: i for i, names in enumerate((
+    ('monday', 'mon'), ('tuesday', 'tue', 'tues'), ('wednesday', 'wed'), ('thursday', 'thu', 'thur', 'thurs'),
+    ('friday', 'fri'), ('saturday', 'sat'), ('sunday', 'sun'),
+)) for name in names}
+RRULE_DAYS = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+
+MONTHS = {name: i + 1 for i, names in enumerate((
+    ('january', 'jan'), ('february', 'feb'), ('march', 'mar'), ('april', 'apr'), ('may',), ('june', 'jun'),
+    ('july', 'jul'), ('august', 'aug'), ('september', 'sep', 'sept'), ('october', 'oct'), ('november', 'nov'),
+    ('december', 'dec'),
+)) for name in names}
+
+NUMBERS = {'a': 1, 'an': 1, 'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5, 'six': 6, 'ten': 10,
+           'fifteen': 15, 'twenty': 20, 'thirty': 30, 'forty-five': 45, 'ninety': 90, 'half an': 0.5, 'half a': 0.5}
+UNITS = {'m': 'minutes', 'min': 'minutes', 'mins': 'minutes', 'minute': 'minutes', 'minutes': 'minutes',
+         'h': 'hours', 'hr': 'hours', 'hrs': 'hours', 'hour': 'hours', 'hours': 'hours',
+         'd': 'days', 'day': 'days', 'days': 'days', 'w': 'weeks', 'week': 'weeks', 'weeks': 'weeks'}
+
+RECURRENCE_SHORTHANDS = {
+    'daily': 'FREQ=DAILY',
+    'every day': 'FREQ=DAILY',
+    'weekly': 'FREQ=WEEKLY',
+    'every week': 'FREQ=WEEKLY',
+    'biweekly': 'FREQ=WEEKLY;INTERVAL=2',
+    'every other week': 'FREQ=WEEKLY;INTERVAL=2',
+    'weekdays': 'FREQ=WEEKLY;BYDAY=MO,TU,WE,TH,FR',
+    'every weekday': 'FREQ=WEEKLY;BYDAY=MO,TU,WE,TH,FR',
+    'monthly': 'FREQ=MONTHLY',
+    'every month': 'FREQ=MONTHLY',
+    'yearly': 'FREQ=YEARLY',
+    'annually': 'FREQ=YEARLY',
+    'every year': 'FREQ=YEARLY',
+}
+
+NUMBER = r'(\d+(?:\.\d+)?|(?<![a-z])(?:' + '|'.join(sorted(map(re.escape, NUMBERS), key=len, reverse=True)) + '))'
+UNIT = '(' + '|'.join(sorted(UNITS, key=len, reverse=True)) + ')(?![a-z])'
+DURATION_PART = re.compile(NUMBER + r'\s*' + UNIT)
+ISO_DURATION = re.compile(r'^P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$')
+IN_DELTA = re.compile(r'^in\s+(.+)$')
+TIME_OF_DAY = re.compile(r'(?:\bat\s+)?\b(\d{1,2})(?:[:.](\d{2}))?\s*(am|pm|a\.m\.?|p\.m\.?)(?!\w)|(?:\bat\s+)?\b(\d{1,2})[:.](\d{2})\b|\bat\s+(\d{1,2})\b|\b(noon|midday|midnight)\b')
+ISO_DATE = re.compile(r'\b(\d{4})-(\d{2})-(\d{2})\b')
+DAY_MONTH = re.compile(r'\b(\d{1,2})(?:st|nd|rd|th)?\s+(?:of\s+)?([a-z]+)\.?(?:,?\s+(\d{4}))?\b')
+MONTH_DAY = re.compile(r'\b([a-z]+)\.?\s+(\d{1,2})(?:st|nd|rd|th)?(?:,?\s+(\d{4}))?\b')
+WEEKDAY = re.compile(r'\b(?:(this|next|coming)\s+)?(' + '|'.join(sorted(WEEKDAYS, key=len, reverse=True)) + r')\b')
+# A UTC offset as typed: 'UTC+7', 'GMT-05:00', '+05:45'
+UTC_OFFSET = re.compile(r'(?:utc|gmt)?\s*([+-])\s*(\d{1,2})(?::?(\d{2}))?')
+# How normalize_timezone names offsets that no Etc/GMT zone covers
+FIXED_OFFSET = re.compile(r'UTC([+-])(\d{2}):(\d{2})')
+EMAIL = re.compile(r'^[^@\s,;]+@[^@\s,;]+\.[^@\s,;]+$')
+
+
+class DateResolutionError(ValueError):
+    """A date, time, duration, timezone or recurrence that could not be understood"""
+
+
+@lru_cache(maxsize=1)
+def _zone_names():
+    """Lower-case IANA names and unambiguous city names mapped to the canonical zone"""
+    names = {}
+    cities = {}
+    for zone in available_timezones():
+        names[zone.lower()] = zone
+        if zone.startswith('Etc/'):
+            # 'GMT+7' is not a city: Etc/GMT+7 is UTC-7
+            continue
+        city = zone.rsplit('/', 1)[-1].lower().replace('_', ' ')
+        cities.setdefault(city, set()).add(zone)
+    for city, zones in cities.items():
+        if len(zones) == 1 and city not in names:
+            names[city] = zones.pop()
+    return names
+
+
+def normalize_timezone(value, default=DEFAULT_TIMEZONE):
+    """Map an IANA name in any case, a common abbreviation ('WIB', 'ET'), a city or a UTC offset to an IANA name.
+
+    Whole-hour offsets become Etc/GMT zones; others, like 'UTC+05:30', are
+    returned in that form and read by `zone` as a fixed offset.
+    """
+    if value is None or not str(value).strip():
+        return default
+    text = ' '.join(str(value).strip().split())
+    key = text.lower()
+
+    # Before the names: Etc/GMT+7 is UTC-7, the opposite of what 'GMT+7' means
+    offset = UTC_OFFSET.fullmatch(key)
+    if offset:
+        sign, hours, minutes = offset.group(1), int(offset.group(2)), int(offset.group(3) or 0)
+        if minutes >= 60 or hours * 60 + minutes > 14 * 60:
+            raise DateResolutionError(f"'{value}' is not a valid UTC offset")
+        if hours == minutes == 0:
+            return 'UTC'
+        if minutes:
+            return f"UTC{sign}{hours:02d}:{minutes:02d}"
+        # POSIX-style Etc zones have the sign inverted: UTC+7 is Etc/GMT-7
+        return f"Etc/GMT{'-' if sign == '+' else '+'}{hours}"
+
+    for candidate in (key, re.sub(r'\s+(standard\s+|daylight\s+)?time$', '', key)):
+        if candidate in TIMEZONE_ALIASES:
+            return TIMEZONE_ALIASES[candidate]
+        zone = _zone_names().get(candidate) or _zone_names().get(candidate.replace(' ', '_'))
+        if zone:
+            return zone
+    raise DateResolutionError(f"Unknown timezone '{value}'; use an IANA name like 'Asia/Jakarta' or 'America/New_York'")
+
+
+def zone(name):
+    """The tzinfo of a name returned by normalize_timezone"""
+    offset = FIXED_OFFSET.fullmatch(name)
+    if offset:
+        delta = datetime.timedelta(hours=int(offset.group(2)), minutes=int(offset.group(3)))
+        return datetime.timezone(delta if offset.group(1) == '+' else -delta, name)
+    return ZoneInfo(name)
+
+
+def iana_name(name):
+    """`name` if Google Calendar accepts it as a timeZone, None for a fixed offset"""
+    return None if FIXED_OFFSET.fullmatch(name) else name
+
+
+def user_timezone(value):
+    """The timezone a client reported, falling back to DEFAULT_TIMEZONE"""
+    try:
+        return normalize_timezone(value)
+    except DateResolutionError as e:
+        print(f"Ignoring client timezone: {e}")
+        return DEFAULT_TIMEZONE
+
+
+def parse_duration(value):
+    """Return a timedelta for 'PT1H30M', '90 minutes', '1h 30m', 'half an hour' etc., or None"""
+    text = str(value).strip()
+    iso = ISO_DURATION.match(text.upper())
+    if iso and any(iso.groups()):
+        weeks, days, hours, minutes, seconds = (int(g or 0) for g in iso.groups())
+        return datetime.timedelta(weeks=weeks, days=days, hours=hours, minutes=minutes, seconds=seconds)
+
+    text = text.lower()
+    parts = list(DURATION_PART.finditer(text))
+    leftover = DURATION_PART.sub(' ', text).replace('and', ' ').replace(',', ' ').replace('for', ' ')
+    if not parts or leftover.strip():
+        return None
+    delta = datetime.timedelta()
+    for part in parts:
+        amount = NUMBERS.get(part.group(1))
+        amount = float(part.group(1)) if amount is None else amount
+        delta += datetime.timedelta(**{UNITS[part.group(2)]: amount})
+    return delta if delta else None
+
+
+def _time_of_day(match):
+    hour_ampm, minute_ampm, ampm, hour, minute, at_hour, word = match.groups()
+    if word:
+        return datetime.time(12) if word in ('noon', 'midday') else datetime.time(0)
+    if ampm:
+        hour, minute = int(hour_ampm), int(minute_ampm or 0)
+        if not 1 <= hour <= 12:
+            raise DateResolutionError(f"'{match.group(0).strip()}' is not a valid time")
+        hour = hour % 12 + (12 if ampm.startswith('p') else 0)
+    else:
+        hour, minute = int(hour if hour is not None else at_hour), int(minute or 0)
+    if hour > 23 or minute > 59:
+        raise DateResolutionError(f"'{match.group(0).strip()}' is not a valid time")
+    return datetime.time(hour, minute)
+
+
+def _day(text, today):
+    """Resolve the day part of an expression to (date, fixed) or None.
+
+    `fixed` is False for a day and month without a year and None for a bare
+    weekday, which may still move forward when they turn out to be past.
+    """
+    if not text:
+        return None
+    if text in ('today', 'tonight', 'this evening', 'this morning', 'this afternoon'):
+        return today, True
+    if text == 'tomorrow':
+        return today + datetime.timedelta(days=1), True
+    if text in ('day after tomorrow', 'the day after tomorrow'):
+        return today + datetime.timedelta(days=2), True
+    if text == 'yesterday':
+        return today - datetime.timedelta(days=1), True
+    if text == 'next week':
+        return today + datetime.timedelta(days=7 - today.weekday()), True
+
+    match = ISO_DATE.fullmatch(text)
+    if match:
+        return datetime.date(*map(int, match.groups())), True
+
+    match = WEEKDAY.fullmatch(text)
+    if match:
+        ahead = (WEEKDAYS[match.group(2)] - today.weekday()) % 7
+        if match.group(1) == 'next' and ahead == 0:
+            ahead = 7
+        return today + datetime.timedelta(days=ahead), True if match.group(1) else None
+
+    for pattern, day_group, month_group in ((DAY_MONTH, 1, 2), (MONTH_DAY, 2, 1)):
+        match = pattern.fullmatch(text)
+        if match and match.group(month_group) in MONTHS:
+            year = int(match.group(3)) if match.group(3) else today.year
+            try:
+                date = datetime.date(year, MONTHS[match.group(month_group)], int(match.group(day_group)))
+            except ValueError:
+                raise DateResolutionError(f"'{text}' is not a valid date")
+            return date, bool(match.group(3))
+    return None
+
+
+def resolve_datetime(value, tz, now=None, base=None, default_time=None, field='date'):
+    """Resolve ISO 8601 or a relative expression to an aware datetime in `tz`.
+
+    Understands 'tomorrow 3pm', 'next friday 09:30', '31 August at 14:00',
+    'in 2 hours' and plain times. A time without a day falls on `base`
+    (default today), and a day without a time gets `default_time`; when
+    that is None a time is required. A day named without a year, or a time
+    without a day, that has already passed moves to the next occurrence.
+    """
+    tz = zone(tz) if isinstance(tz, str) else tz
+    now = (now or datetime.datetime.now(tz)).astimezone(tz)
+    text = ' '.join(str(value or '').strip().split())
+    if not text:
+        raise DateResolutionError(f"{field} is empty")
+
+    parsed = None
+    # fromisoformat reads a bare date as midnight; it is a day without a time
+    if not ISO_DATE.fullmatch(text):
+        try:
+            parsed = datetime.datetime.fromisoformat(text)
+        except ValueError:
+            pass
+    if parsed is not None:
+        # An explicit offset names an instant; naive values are wall-clock time in tz
+        return parsed.astimezone(tz) if parsed.tzinfo else parsed.replace(tzinfo=tz)
+
+    lowered = text.lower().rstrip('.')
+    if lowered == 'now':
+        return now.replace(second=0, microsecond=0)
+    match = IN_DELTA.match(lowered)
+    if match:
+        delta = parse_duration(match.group(1))
+        if delta is None:
+            raise DateResolutionError(f"Could not understand {field} '{text}'")
+        return (now + delta).replace(second=0, microsecond=0)
+
+    time_match = TIME_OF_DAY.search(lowered)
+    time_of_day = _time_of_day(time_match) if time_match else None
+    rest = TIME_OF_DAY.sub(' ', lowered) if time_match else lowered
+    rest = ' '.join(re.sub(r'\b(on|at)\b|,', ' ', rest).split())
+    day = _day(rest, now.date())
+    if rest and day is None:
+        raise DateResolutionError(
+            f"Could not understand {field} '{text}'; use ISO 8601 like '2025-05-28T09:00:00' or e.g. 'tomorrow 3pm'")
+
+    if time_of_day is None:
+        if default_time is None:
+            raise DateResolutionError(f"{field} '{text}' needs a time of day; ask the user what time they mean")
+        time_of_day = default_time
+
+    if day is None:
+        date = base or now.date()
+        result = datetime.datetime.combine(date, time_of_day, tz)
+        if base is None and result < now:
+            result += datetime.timedelta(days=1)
+        return result
+
+    date, fixed = day
+    result = datetime.datetime.combine(date, time_of_day, tz)
+    if fixed is None and result < now:
+        result += datetime.timedelta(days=7)
+    elif fixed is False and result.date() < now.date():
+        result = result.replace(year=result.year + 1)
+    return result
+
+
+def resolve_end(value, start, tz, now=None, field='end_date'):
+    """End of an event: a datetime, a time on the start's day, or a duration after start"""
+    if value is None or not str(value).strip():
+        return start + datetime.timedelta(minutes=DEFAULT_EVENT_MINUTES)
+    text = str(value).strip()
+    for prefix in ('for ', 'lasting ', ''):
+        if text.lower().startswith(prefix):
+            delta = parse_duration(text[len(prefix):])
+            if delta is not None:
+                return start + delta
+
+    end = resolve_datetime(text, tz, now, base=start.date(), field=field)
+    if end <= start and not _has_date(text):
+        # A bare end time earlier than the start, e.g. 22:00-01:00, ends the next day
+        end += datetime.timedelta(days=1)
+    if end <= start:
+        raise DateResolutionError(f"{field} {end.isoformat()} is not after start_date {start.isoformat()}")
+    return end
+
+
+def _has_date(text):
+    try:
+        datetime.datetime.fromisoformat(text)
+        return True
+    except ValueError:
+        return False
+
+
+def normalize_rrule(value, start, tz):
+    """Validate a recurrence rule and return it as 'RRULE:...', or None for no recurrence.
+
+    Accepts a missing 'RRULE:' prefix, lower case, spaces, day names
+    ('MONDAY', 'Mon') and shorthands like 'weekly' or 'weekdays'. UNTIL is
+    rewritten in UTC as Google Calendar requires, and COUNT wins when both
+    COUNT and UNTIL are given.
+    """
+    if value is None or not str(value).strip() or str(value).strip().lower() in ('none', 'null', 'no', 'never'):
+        return None
+    text = str(value).strip()
+    rule = RECURRENCE_SHORTHANDS.get(text.lower(), text)
+    rule = re.sub(r'^\s*rrule\s*:', '', rule, flags=re.I)
+
+    parts = {}
+    for item in rule.replace(' ', '').strip(';').split(';'):
+        key, sep, val = item.partition('=')
+        if not sep or not val:
+            raise DateResolutionError(f"Invalid recurrence '{value}'; use RRULE format like 'RRULE:FREQ=WEEKLY;BYDAY=MO'")
+        parts[key.upper()] = val.upper()
+    if 'FREQ' not in parts:
+        raise DateResolutionError(f"Recurrence '{value}' has no FREQ")
+
+    if 'BYDAY' in parts:
+        days = []
+        for day in parts['BYDAY'].split(','):
+            match = re.fullmatch(r'([+-]?\d*)([A-Z]+)', day)
+            if not match:
+                raise DateResolutionError(f"Invalid day '{day}' in recurrence '{value}'")
+            prefix, name = match.groups()
+            code = RRULE_DAYS[WEEKDAYS[name.lower()]] if name.lower() in WEEKDAYS else name
+            if code not in RRULE_DAYS:
+                raise DateResolutionError(f"Invalid day '{day}' in recurrence '{value}'")
+            days.append(prefix + code)
+        parts['BYDAY'] = ','.join(days)
+    if 'COUNT' in parts:
+        parts.pop('UNTIL', None)
+    elif 'UNTIL' in parts:
+        parts['UNTIL'] = _until_utc(parts['UNTIL'], tz)
+
+    normalized = 'RRULE:' + ';'.join(f'{key}={val}' for key, val in sorted(parts.items(), key=lambda item: item[0] != 'FREQ'))
+    try:
+        occurrence = next(iter(rrulestr(normalized, dtstart=start)), None)
+    except (ValueError, TypeError) as e:
+        raise DateResolutionError(f"Invalid recurrence '{value}': {e}")
+    if occurrence is None:
+        raise DateResolutionError(f"Recurrence '{value}' has no occurrences after {start.isoformat()}")
+    return normalized
+
+
+def _until_utc(value, tz):
+    compact = value.replace('-', '').replace(':', '')
+    try:
+        if len(compact) == 8:
+            # A date-only UNTIL includes that whole day in the event's timezone
+            local = datetime.datetime.combine(datetime.datetime.strptime(compact, '%Y%m%d').date(), datetime.time(23, 59, 59), tz)
+            until = local.astimezone(datetime.timezone.utc)
+        elif compact.endswith('Z'):
+            until = datetime.datetime.strptime(compact, '%Y%m%dT%H%M%SZ')
+        else:
+            until = datetime.datetime.strptime(compact, '%Y%m%dT%H%M%S').replace(tzinfo=tz).astimezone(datetime.timezone.utc)
+    except ValueError:
+        raise DateResolutionError(f"Invalid UNTIL '{value}' in recurrence; use YYYYMMDD")
+    return until.strftime('%Y%m%dT%H%M%SZ')
+
+
+def normalize_attendees(value):
+    """Split, trim and de-duplicate attendee emails, rejecting anything that is not an address"""
+    if not value:
+        return []
+    items = re.split(r'[,;\s]+', value) if isinstance(value, str) else value
+    attendees, invalid = [], []
+    for item in items:
+        email = str(item).strip().strip('<>').strip()
+        if not email:
+            continue
+        if not EMAIL.match(email):
+            invalid.append(email)
+        elif email.lower() not in (a.lower() for a in attendees):
+            attendees.append(email)
+    if invalid:
+        raise DateResolutionError(f"Invalid attendee email address(es): {', '.join(invalid)}")
+    return attendees
+
+
+def resolve_event_fields(data, timezone=None, now=None):
+    """Return calendar event fields with timezone, dates, recurrence and attendees normalized.
+
+    `timezone` is the user's timezone, used when the event names none.
+    Raises DateResolutionError for values that cannot be repaired.
+    """
+    tz_name = normalize_timezone(data.get('timezone'), default=timezone or DEFAULT_TIMEZONE)
+    tz = zone(tz_name)
+    now = (now or datetime.datetime.now(tz)).astimezone(tz)
+    start = resolve_datetime(data.get('start_date'), tz, now, field='start_date')
+    end = resolve_end(data.get('end_date'), start, tz, now)
+    if data.get('recurrence') and not iana_name(tz_name):
+        # Google expands recurring events in a named zone
+        raise DateResolutionError(f"A recurring event needs a named timezone like 'Asia/Kolkata', not {tz_name}")
+    return {
+        **data,
+        'timezone': tz_name,
+        'start_date': start.isoformat(),
+        'end_date': end.isoformat(),
+        'recurrence': normalize_rrule(data.get('recurrence'), start, tz),
+        'attendees': normalize_attendees(data.get('attendees')),
+    }
+
+
+def resolve_window(start_date, end_date, timezone=None, now=None):
+    """Resolve a search window; a bare start day begins at midnight and a bare end day runs to its end"""
+    tz_name = normalize_timezone(timezone)
+    tz = zone(tz_name)
+    now = (now or datetime.datetime.now(tz)).astimezone(tz)
+    start = resolve_datetime(start_date, tz, now, default_time=datetime.time(0), field='start_date')
+    end = resolve_datetime(end_date, tz, now, default_time=datetime.time(23, 59, 59), field='end_date')
+    if end <= start:
+        raise DateResolutionError(f"end_date {end.isoformat()} is not after start_date {start.isoformat()}")
+    return start.isoformat(), end.isoformat(), tz_name
+
+
+def current_date_instructions(timezone, now=None):
+    """Today's date and the coming week in the user's timezone, for the run instructions"""
+    tz = zone(timezone)
+    today = (now or datetime.datetime.now(tz)).astimezone(tz)
+    days = ', '.join(
+        f"{day:%a} {day:%Y-%m-%d}" + (' (tomorrow)' if i == 1 else '')
+        for i, day in ((i, today + datetime.timedelta(days=i)) for i in range(1, INSTRUCTION_DAYS + 1))
+    )
+    offset = today.strftime('%z')
+    return (
+        f"Today is {today:%A %Y-%m-%d} in the user's timezone {timezone} (UTC{offset[:3]}:{offset[3:]}). "
+        f"Coming days: {days}. Use these for relative dates such as 'tomorrow', 'this Sunday' or '31 August'; "
+        "you do not need get_current_date for them. create_event and find_free_slot also accept expressions "
+        "like 'tomorrow 3pm' or 'next friday 09:30', and end_date may be a duration such as '45 minutes'."
+    )
+
+
+def current_date_scope(timezone, now=None):
+    """Key for answers that are only valid on this date in this timezone"""
+    tz = zone(timezone)
+    return f"{(now or datetime.datetime.now(tz)).astimezone(tz):%Y-%m-%d}:{timezone}"
@@ -0,0 +1,90 @@
+import os
+import json
+import threading
+
+DISCOVERY_CACHE_DIR = os.getenv('DISCOVERY_CACHE_DIR', '.discovery_cache')
+DISCOVERY_FETCH_TIMEOUT = float(os.getenv('DISCOVERY_FETCH_TIMEOUT', '30'))
+
+
+class DiscoveryCache:
+    """Parsed Google API discovery documents, shared by every `build()` in the process.
+
+    googleapiclient's `build()` reads and parses the service's discovery JSON
+    on every call. Here each document is parsed once, primed by building the
+    service and all of its nested resources (googleapiclient adds its own
+    parameters to the document in place on first use), and then reused by
+    `build_from_document`. The raw JSON is kept in DISCOVERY_CACHE_DIR, so
+    later processes read a local file even when the installed
+    googleapiclient has no bundled copy and the document had to be fetched.
+    """
+
+    def __init__(self, path=DISCOVERY_CACHE_DIR):
+        self.path = path
+        self._documents = {}
+        self._lock = threading.Lock()
+
+    def build(self, api, version, credentials=None):
+        """Blocking; run through google_io"""
+        from googleapiclient.discovery import build_from_document
+        return build_from_document(self.document(api, version), credentials=credentials)
+
+    def document(self, api, version):
+        key = (api, version)
+        document = self._documents.get(key)
+        if document is None:
+            with self._lock:
+                document = self._documents.get(key)
+                if document is None:
+                    document = json.loads(self._read(api, version))
+                    self._prime(document)
+                    self._documents[key] = document
+        return document
+
+    def _read(self, api, version):
+        file = os.path.join(self.path, f'{api}.{version}.json')
+        try:
+            with open(file) as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+        content = self._fetch(api, version)
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(f'{file}.tmp', 'w') as f:
+                f.write(content)
+            os.replace(f'{file}.tmp', file)
+        except OSError as e:
+            print(f"Could not persist discovery document {api}.{version}: {e}")
+        return content
+
+    @staticmethod
+    def _fetch(api, version):
+        from googleapiclient.discovery_cache import get_static_doc
+        content = get_static_doc(api, version)
+        if content is None:
+            import httplib2
+            from googleapiclient.discovery import V2_DISCOVERY_URI
+            resp, content = httplib2.Http(timeout=DISCOVERY_FETCH_TIMEOUT).request(
+                V2_DISCOVERY_URI.format(api=api, apiVersion=version))
+            if resp.status >= 400:
+                raise Exception(f"Could not fetch discovery document {api}.{version}: HTTP {resp.status}")
+            content = content.decode()
+        return content
+
+    @staticmethod
+    def _prime(document):
+        import httplib2
+        from googleapiclient.discovery import build_from_document, fix_method_name
+
+        def walk(resource, description):
+            for name, child in description.get('resources', {}).items():
+                walk(getattr(resource, fix_method_name(name))(), child)
+
+        walk(build_from_document(document, http=httplib2.Http()), document)
+
+    def warm(self, apis):
+        for api, version in apis:
+            self.document(api, version)
+
+
+discovery_cache = DiscoveryCache()
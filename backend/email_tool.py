@@ -1,30 +1,57 @@
 import base64
 import os.path
+import uuid
+import tempfile
+import mimetypes
+from email import policy
 from email.message import EmailMessage
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import json
+import os
+import random
+import asyncio
 
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-import firebase_admin
-from firebase_admin import credentials, firestore_async
+from functools import partial
 from token_encryption import token_encryptor
+from service_cache import CachedService, service_cache
+from google_io import google_io
+from discovery_cache import discovery_cache
+from firestore_client import firestore_client
+from telemetry import span
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = ["https://www.googleapis.com/auth/gmail.send"]
 
-async def get_gmail_service(user_id):
-    """Get authenticated Gmail service using OAuth 2.0"""
+# Gmail accepts up to 100 calls per batch but recommends at most 50
+GMAIL_BATCH_SIZE = int(os.getenv('GMAIL_BATCH_SIZE', '50'))
+GMAIL_BATCH_CONCURRENCY = int(os.getenv('GMAIL_BATCH_CONCURRENCY', '2'))
+GMAIL_BATCH_RETRIES = int(os.getenv('GMAIL_BATCH_RETRIES', '4'))
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# Files the agent may attach live in ATTACHMENTS_DIR/<user_id>/
+ATTACHMENTS_DIR = os.getenv('ATTACHMENTS_DIR', 'attachments')
+# Gmail's upload limit for messages.send
+GMAIL_MAX_MESSAGE_BYTES = int(os.getenv('GMAIL_MAX_MESSAGE_BYTES', str(35 * 1024 * 1024)))
+# Resumable upload chunks must be a multiple of 256 KiB
+GMAIL_UPLOAD_CHUNK_SIZE = max(1, int(os.getenv('GMAIL_UPLOAD_CHUNK_SIZE', str(4 * 1024 * 1024))) // (256 * 1024)) * 256 * 1024
+GMAIL_UPLOAD_RETRIES = int(os.getenv('GMAIL_UPLOAD_RETRIES', '5'))
+GMAIL_UPLOAD_CHUNK_TIMEOUT = float(os.getenv('GMAIL_UPLOAD_CHUNK_TIMEOUT', '300'))
+# Upload sessions that expired (404/410) start over at most this many times
+GMAIL_UPLOAD_RESTARTS = int(os.getenv('GMAIL_UPLOAD_RESTARTS', '1'))
+# Bytes read per base64 step; a multiple of 57 so every line is a full 76 characters
+ATTACHMENT_READ_SIZE = 57 * 1024
+
+async def get_gmail_service(user_id, db=None):
+    """Get authenticated Gmail service using OAuth 2.0, reusing the cached client while its token is valid"""
+    return await service_cache.get_or_load(user_id, 'gmail', partial(_load_gmail_service, db=db or firestore_client.db))
+
+async def _load_gmail_service(user_id, cached, db):
+    """Load Gmail credentials from Firestore and build the service"""
+    # Imported here so the API server starts without loading google-auth
+    from google.oauth2.credentials import Credentials
     try:
-        if not firebase_admin._apps:
-            cred = credentials.Certificate("serviceAccountKey.json")
-            firebase_admin.initialize_app(cred)
-        
-        db = firestore_async.client()
         services_database = db.collection('services')
         
         user_doc = await services_database.document(user_id).get()
@@ -32,22 +59,29 @@ async def get_gmail_service(user_id):
             encrypted_token = user_doc.to_dict().get('token_gmail')
             if encrypted_token:
                 try:
+                    if cached and cached.token == encrypted_token and cached.creds.valid:
+                        return cached.touch()
+
                     token_data = token_encryptor.decrypt_token(encrypted_token)
                     creds = Credentials.from_authorized_user_info(json.loads(token_data), SCOPES)
                     if creds and creds.valid:
-                        return build("gmail", "v1", credentials=creds)
+                        service = await google_io.run(discovery_cache.build, "gmail", "v1", credentials=creds)
+                        return CachedService(service, creds, encrypted_token)
                     elif creds and creds.expired and creds.refresh_token:
-                        creds.refresh(Request())
+                        with span('token_refresh', service='gmail'):
+                            await google_io.refresh(creds)
                         encrypted_updated_token = token_encryptor.encrypt_token(creds.to_json())
                         await services_database.document(user_id).update({
                             'token_gmail': encrypted_updated_token
                         })
-                        return build("gmail", "v1", credentials=creds)
+                        service = await google_io.run(discovery_cache.build, "gmail", "v1", credentials=creds)
+                        return CachedService(service, creds, encrypted_updated_token)
                 except Exception as e:
                     print(e)
                     
         
         if os.path.exists("credentials.json"):
+            from google_auth_oauthlib.flow import InstalledAppFlow
             flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
             creds = flow.run_local_server(port=8002)
             
@@ -62,48 +96,239 @@ async def get_gmail_service(user_id):
                     'token_gmail': encrypted_token
                 })
             
-            return build("gmail", "v1", credentials=creds)
+            service = await google_io.run(discovery_cache.build, "gmail", "v1", credentials=creds)
+            return CachedService(service, creds, encrypted_token)
         else:
             raise Exception(f"No credentials.json file found and no valid Gmail token for user {user_id}")
     except Exception as e:
         print(f"Error getting Gmail service: {e}")
         raise
 
-async def gmail_send_message(to, origin, subject, content, user_id):
+def build_message(to, origin, subject, content):
+    """Build the Gmail API body for an HTML email"""
+    message = MIMEMultipart('alternative')
+    message["To"] = to
+    message["From"] = origin
+    message["Subject"] = subject
+    
+    html_part = MIMEText(content, 'html')
+    message.attach(html_part)
+
+    # encoded message
+    encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
+
+    return {"raw": encoded_message}
+
+def resolve_attachments(user_id, names):
+    """Paths of the named files in the user's attachment directory
+
+    Raises ValueError for names outside that directory, missing files and
+    attachments too large for one Gmail message.
+    """
+    if not names:
+        return []
+    root = os.path.realpath(ATTACHMENTS_DIR)
+    user_dir = os.path.realpath(os.path.join(root, user_id))
+    if os.path.dirname(user_dir) != root:
+        raise ValueError(f"Invalid user id for attachments: {user_id!r}")
+    paths = []
+    for name in dict.fromkeys(names):
+        path = os.path.realpath(os.path.join(user_dir, name))
+        if os.path.commonpath([path, user_dir]) != user_dir:
+            raise ValueError(f"Attachment {name!r} is outside the attachments directory")
+        if not os.path.isfile(path):
+            raise ValueError(f"Attachment {name!r} not found")
+        paths.append(path)
+    # base64 grows the files by a third
+    if sum(os.path.getsize(path) for path in paths) * 4 // 3 > GMAIL_MAX_MESSAGE_BYTES:
+        raise ValueError(f"Attachments exceed Gmail's {GMAIL_MAX_MESSAGE_BYTES // (1024 * 1024)} MB message limit")
+    return paths
+
+def write_message(file, to, origin, subject, content, paths):
+    """Write an HTML email with the given files attached to a binary file object
+
+    The headers and HTML part come from the email package. Attachments are
+    base64-encoded straight from disk into the placeholders left for them,
+    ATTACHMENT_READ_SIZE bytes at a time, so memory use does not grow with
+    their size.
+    """
+    message = EmailMessage(policy=policy.SMTP)
+    message["To"] = to
+    message["From"] = origin
+    message["Subject"] = subject
+    message.set_content(content, subtype='html')
+    message.make_mixed()
+
+    placeholders = []
+    for path in paths:
+        placeholder = f'attachment-{uuid.uuid4().hex}'
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        part = EmailMessage(policy=policy.SMTP)
+        part['Content-Type'] = mimetype
+        part.add_header('Content-Disposition', 'attachment', filename=os.path.basename(path))
+        part['Content-Transfer-Encoding'] = 'base64'
+        part.set_payload(placeholder)
+        message.attach(part)
+        placeholders.append((placeholder.encode(), path))
+
+    skeleton = message.as_bytes()
+    for placeholder, path in placeholders:
+        head, skeleton = skeleton.split(placeholder, 1)
+        file.write(head)
+        with open(path, 'rb') as f:
+            while chunk := f.read(ATTACHMENT_READ_SIZE):
+                file.write(base64.encodebytes(chunk).replace(b'\n', b'\r\n'))
+    file.write(skeleton)
+
+def _write_message_file(to, origin, subject, content, paths):
+    """Write the message to a temporary file and return its path"""
+    fd, path = tempfile.mkstemp(prefix='gmail-', suffix='.eml')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write_message(f, to, origin, subject, content, paths)
+        if os.path.getsize(path) > GMAIL_MAX_MESSAGE_BYTES:
+            raise ValueError(f"Message exceeds Gmail's {GMAIL_MAX_MESSAGE_BYTES // (1024 * 1024)} MB limit")
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+async def upload_message(service, path):
+    """Send the RFC 822 message in `path` through Gmail's resumable upload endpoint
+
+    The file is uploaded GMAIL_UPLOAD_CHUNK_SIZE bytes at a time. A chunk
+    that fails with a connection error, 429 or 5xx is retried up to
+    GMAIL_UPLOAD_RETRIES times with backoff, resuming from the last byte
+    Gmail acknowledged. An expired upload session starts over.
+    Returns: Message object, including message id
+    """
+    from googleapiclient.http import MediaIoBaseUpload
+
+    size = os.path.getsize(path)
+    with span('gmail_upload', bytes=size):
+        for restart in range(GMAIL_UPLOAD_RESTARTS + 1):
+            with open(path, 'rb') as f:
+                media = MediaIoBaseUpload(f, mimetype='message/rfc822', chunksize=GMAIL_UPLOAD_CHUNK_SIZE, resumable=True)
+                request = service.users().messages().send(userId="me", media_body=media)
+                response = None
+                try:
+                    while response is None:
+                        _, response = await google_io.next_chunk(request, timeout=GMAIL_UPLOAD_CHUNK_TIMEOUT,
+                                                                 num_retries=GMAIL_UPLOAD_RETRIES)
+                    return response
+                except HttpError as error:
+                    if error.resp.status not in (404, 410) or restart == GMAIL_UPLOAD_RESTARTS:
+                        raise
+                    print(f"Gmail upload session expired after {request.resumable_progress}/{size} bytes, restarting")
+
+async def gmail_deliver(to, origin, subject, content, user_id, db=None, attachments=None):
+    """Send one email, raising HttpError on failure
+    Messages with attachments are written to a temporary file and sent with
+    a resumable upload; others go in the request body.
+    Returns: Message object, including message id
+    """
+    with service_cache.invalidate_on_auth_error(user_id, 'gmail'):
+        service = await get_gmail_service(user_id, db)
+
+        if attachments:
+            paths = resolve_attachments(user_id, attachments)
+            path = await asyncio.to_thread(_write_message_file, to, origin, subject, content, paths)
+            try:
+                send_message = await upload_message(service, path)
+            finally:
+                os.remove(path)
+        else:
+            create_message = build_message(to, origin, subject, content)
+
+            send_message = await google_io.execute(
+                service.users()
+                .messages()
+                .send(userId="me", body=create_message)
+            )
+    print(f'Message Id: {send_message["id"]}')
+    return send_message
+
+async def gmail_send_message(to, origin, subject, content, user_id, db=None, attachments=None):
     """Create and send an email message
+    `attachments` are file names in the user's attachment directory.
     Print the returned message id
     Returns: Message object, including message id
     """
     try:
-        service = await get_gmail_service(user_id)
-        
-        message = MIMEMultipart('alternative')
-        message["To"] = to
-        message["From"] = origin
-        message["Subject"] = subject
-        
-        html_part = MIMEText(content, 'html')
-        message.attach(html_part)
-
-        # encoded message
-        encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-
-        create_message = {"raw": encoded_message}
-        
-        send_message = (
-            service.users()
-            .messages()
-            .send(userId="me", body=create_message)
-            .execute()
-        )
-        print(f'Message Id: {send_message["id"]}')
-        
+        send_message = await gmail_deliver(to, origin, subject, content, user_id, db, attachments)
     except HttpError as error:
         print(f"An error occurred: {error}")
         send_message = None
         
     return send_message
 
+async def gmail_send_bulk(recipients, origin, subject, content, user_id, db=None):
+    """Send the same email to each recipient separately using Gmail batch requests
+    Recipients are grouped GMAIL_BATCH_SIZE per HTTP batch, with at most
+    GMAIL_BATCH_CONCURRENCY batches in flight. Sends that fail with 429/5xx
+    are retried with exponential backoff.
+    Returns: list of {'to', 'status', 'id'|'error'} in recipient order
+    """
+    service = await get_gmail_service(user_id, db)
+    recipients = list(dict.fromkeys(recipients))
+    results = {}
+    semaphore = asyncio.Semaphore(GMAIL_BATCH_CONCURRENCY)
+
+    pending = recipients
+    for attempt in range(GMAIL_BATCH_RETRIES + 1):
+        if attempt:
+            await asyncio.sleep(min(32, 2 ** (attempt - 1)) + random.random())
+
+        chunks = [pending[i:i + GMAIL_BATCH_SIZE] for i in range(0, len(pending), GMAIL_BATCH_SIZE)]
+        outcomes = await asyncio.gather(*[
+            _send_batch(service, chunk, origin, subject, content, semaphore) for chunk in chunks
+        ])
+
+        pending = []
+        for outcome in outcomes:
+            for to, (result, retryable) in outcome.items():
+                results[to] = result
+                if retryable:
+                    pending.append(to)
+        if not pending:
+            break
+
+    sent = sum(1 for r in results.values() if r['status'] == 'sent')
+    print(f"Bulk send: {sent}/{len(recipients)} sent")
+    return [results[to] for to in recipients]
+
+async def _send_batch(service, chunk, origin, subject, content, semaphore):
+    """Send one batch; returns {to: (result, retryable)}"""
+    outcome = {}
+
+    def callback(request_id, response, exception):
+        to = chunk[int(request_id)]
+        if exception is None:
+            outcome[to] = ({'to': to, 'status': 'sent', 'id': response.get('id')}, False)
+        else:
+            status = getattr(getattr(exception, 'resp', None), 'status', None)
+            outcome[to] = ({'to': to, 'status': 'failed', 'error': str(exception)}, status in RETRYABLE_STATUSES)
+
+    batch = service.new_batch_http_request(callback=callback)
+    creds = None
+    for i, to in enumerate(chunk):
+        request = service.users().messages().send(userId="me", body=build_message(to, origin, subject, content))
+        creds = creds or getattr(request.http, 'credentials', None)
+        batch.add(request, request_id=str(i))
+
+    async with semaphore:
+        try:
+            await google_io.execute_batch(batch, creds)
+        except HttpError as error:
+            retryable = error.resp.status in RETRYABLE_STATUSES
+            for to in chunk:
+                outcome.setdefault(to, ({'to': to, 'status': 'failed', 'error': str(error)}, retryable))
+        except Exception as error:
+            # The batch may have been partly delivered, so resending could duplicate mail
+            for to in chunk:
+                outcome.setdefault(to, ({'to': to, 'status': 'failed', 'error': str(error)}, False))
+    return outcome
+
 if __name__ == "__main__":
     import asyncio
     asyncio.run(gmail_send_message("test@example.com", "sender@example.com", "Test", "Test content", "test_user_id"))
\ No newline at end of file
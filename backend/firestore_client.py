@@ -0,0 +1,77 @@
+import os
+import asyncio
+import importlib
+
+FIREBASE_CREDENTIALS = os.getenv('FIREBASE_CREDENTIALS', 'serviceAccountKey.json')
+
+
+class FirestoreClient:
+    """The process-wide Firebase app and async Firestore client.
+
+    It also verifies the Firebase Auth ID tokens that endpoints returning
+    a user's data require.
+
+    The API server opens it in its lifespan hook and passes `db` to the tools
+    through the agent deps, so every request and tool call shares one client
+    and its gRPC channel. Scripts that never start the app get the same
+    client lazily on first use of `db`. The Firebase SDK is imported only
+    when the client starts.
+    """
+
+    def __init__(self, credentials_path=FIREBASE_CREDENTIALS):
+        self.credentials_path = credentials_path
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self.start()
+        return self._db
+
+    def start(self):
+        import firebase_admin
+        from firebase_admin import credentials, firestore_async
+        if not firebase_admin._apps:
+            firebase_admin.initialize_app(credentials.Certificate(self.credentials_path))
+        if self._db is None:
+            self._db = firestore_async.client()
+        return self._db
+
+    async def open(self):
+        """Load the Firebase SDK off the event loop, then start the client"""
+        await asyncio.to_thread(importlib.import_module, 'firebase_admin.firestore_async')
+        return self.start()
+
+    async def verify_token(self, id_token):
+        """Return the uid of a Firebase Auth ID token; raises ValueError if it is missing, invalid or expired"""
+        from firebase_admin import auth
+        if not id_token:
+            raise ValueError('Missing ID token')
+        self.start()  # tokens are checked against the Firebase app's project
+        try:
+            # Fetches Google's public keys on first use and when they expire
+            claims = await asyncio.to_thread(auth.verify_id_token, id_token)
+        except auth.InvalidIdTokenError as e:
+            raise ValueError(str(e)) from e
+        return claims['uid']
+
+    async def warm(self):
+        """Open the channel and authenticate before the first request needs it"""
+        try:
+            await self.db.collection('services').document('_warmup').get()
+        except Exception as e:
+            print(f"Firestore warm-up failed: {e}")
+
+    async def close(self):
+        """Close the client and its gRPC channel, which AsyncClient.close() leaves open"""
+        if self._db is None:
+            return
+        db, self._db = self._db, None
+        db.close()
+        # Only set once the client has made a call; reading _firestore_api would open a channel
+        api = getattr(db, '_firestore_api_internal', None)
+        if api is not None:
+            await api.transport.close()
+
+
+firestore_client = FirestoreClient()
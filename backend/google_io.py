@@ -0,0 +1,158 @@
+import os
+import asyncio
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+GOOGLE_IO_WORKERS = int(os.getenv('GOOGLE_IO_WORKERS', '16'))
+GOOGLE_IO_TIMEOUT = float(os.getenv('GOOGLE_IO_TIMEOUT', '30'))
+
+
+class GoogleIO:
+    """Runs blocking googleapiclient/google-auth calls off the event loop.
+
+    Calls go to a bounded thread pool. Each worker thread keeps its own
+    httplib2 connection (httplib2 is not thread-safe), so requests reuse
+    keep-alive connections per thread instead of sharing the one created by
+    `build()`. Every call has a timeout: the socket timeout bounds the worker
+    thread and `asyncio.wait_for` bounds the awaiting coroutine; a call
+    that times out or is cancelled before a worker picks it up never runs.
+    The HTTP and auth transports are imported on first use.
+    """
+
+    def __init__(self, max_workers=GOOGLE_IO_WORKERS, timeout=GOOGLE_IO_TIMEOUT):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='google-io')
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.max_running = 0
+        self.saturated = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+
+    async def run(self, fn, *args, timeout=None, **kwargs):
+        """Run `fn(*args, **kwargs)` in the pool and await its result"""
+        timeout = timeout or self.timeout
+        with self._lock:
+            if self.running + self.queued >= self.max_workers:
+                self.saturated += 1
+            self.queued += 1
+
+        # Whichever of the worker and this coroutine claims the call first
+        # takes it out of `queued`: the worker when it starts it, this
+        # coroutine when it times out or is cancelled before that
+        call = {'claimed': False}
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, self._call, partial(fn, *args, **kwargs), call)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            raise TimeoutError(f"Google API call timed out after {timeout}s")
+        finally:
+            with self._lock:
+                if not call['claimed']:
+                    call['claimed'] = True
+                    self.queued -= 1
+
+    async def execute(self, request, timeout=None, num_retries=0):
+        """Execute a googleapiclient HttpRequest"""
+        return await self.run(self._execute_request, request, num_retries, timeout=timeout)
+
+    async def next_chunk(self, request, timeout=None, num_retries=0):
+        """Upload the next chunk of a resumable media request; returns (status, response)
+
+        googleapiclient keeps the upload session on the request, so after a
+        failed chunk the next call asks the server how much it has and resumes
+        from there. Chunks may run on different worker threads, but never at
+        the same time.
+        """
+        return await self.run(self._next_chunk, request, num_retries, timeout=timeout)
+
+    async def execute_batch(self, batch, creds, timeout=None):
+        """Execute a googleapiclient BatchHttpRequest; results arrive via its callbacks"""
+        return await self.run(self._execute_batch, batch, creds, timeout=timeout)
+
+    async def refresh(self, creds, timeout=None):
+        """Refresh OAuth credentials without blocking the event loop"""
+        from google.auth.transport.requests import Request
+        return await self.run(creds.refresh, Request(), timeout=timeout)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.max_workers,
+                'queued': self.queued,
+                'running': self.running,
+                'max_running': self.max_running,
+                'saturated': self.saturated,
+                'completed': self.completed,
+                'failed': self.failed,
+                'timeouts': self.timeouts,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _call(self, fn, call):
+        with self._lock:
+            if call['claimed']:
+                # Abandoned while queued; nobody is waiting for the result
+                return None
+            call['claimed'] = True
+            self.queued -= 1
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            result = fn()
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self.running -= 1
+        with self._lock:
+            self.completed += 1
+        return result
+
+    def _thread_http(self):
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            import httplib2
+            http = httplib2.Http(timeout=self.timeout)
+            self._local.http = http
+        return http
+
+    def _request_http(self, request):
+        """This thread's connection, authorized like the request; None for requests without credentials"""
+        creds = getattr(getattr(request, 'http', None), 'credentials', None)
+        if creds is None:
+            return None
+        import google_auth_httplib2
+        return google_auth_httplib2.AuthorizedHttp(creds, http=self._thread_http())
+
+    def _execute_request(self, request, num_retries):
+        http = self._request_http(request)
+        if http is None:
+            return request.execute(num_retries=num_retries)
+        return request.execute(http=http, num_retries=num_retries)
+
+    def _next_chunk(self, request, num_retries):
+        http = self._request_http(request)
+        if http is None:
+            return request.next_chunk(num_retries=num_retries)
+        return request.next_chunk(http=http, num_retries=num_retries)
+
+    def _execute_batch(self, batch, creds):
+        import google_auth_httplib2
+        http = google_auth_httplib2.AuthorizedHttp(creds, http=self._thread_http())
+        return batch.execute(http=http)
+
+
+google_io = GoogleIO()
@@ -0,0 +1,280 @@
+import os
+import json
+import time
+import random
+import asyncio
+import sqlite3
+import threading
+from googleapiclient.errors import HttpError
+
+ASYNC_SIDE_EFFECTS = os.getenv('ASYNC_SIDE_EFFECTS', '0') == '1'
+JOB_QUEUE_PATH = os.getenv('JOB_QUEUE_PATH', 'jobs.db')
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '5'))
+JOB_LEASE_SECONDS = float(os.getenv('JOB_LEASE_SECONDS', '120'))
+JOB_STREAM_WAIT = float(os.getenv('JOB_STREAM_WAIT', '30'))
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+POLL_INTERVAL = 0.5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    user_id TEXT,
+    chat_id TEXT,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_after REAL NOT NULL,
+    lease_until REAL,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, run_after);
+"""
+
+FINISHED = ('done', 'failed')
+
+
+def is_retryable(error, idempotent=False):
+    """Whether a failed attempt can run again without repeating its side effect
+
+    429/5xx answers and refused connections mean Google never acted on the
+    request. A timeout or dropped connection may come after it did, so those
+    are only retried for idempotent kinds.
+    """
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRYABLE_STATUSES
+    if isinstance(error, ConnectionRefusedError):
+        return True
+    return idempotent and isinstance(error, (TimeoutError, ConnectionError, OSError))
+
+
+class JobQueue:
+    """Durable SQLite-backed queue for tool side effects (sending email, creating events).
+
+    Jobs are keyed by an idempotency key, so enqueueing the same tool call
+    twice returns the existing job. Workers claim due jobs with a lease inside
+    an IMMEDIATE transaction, so several server processes can share one
+    database file, and a job whose worker died is picked up again once its
+    lease expires. Failed attempts are retried with exponential backoff when
+    the request never reached Google (429/5xx, connection refused). Kinds
+    registered as idempotent are also retried after timeouts and connection
+    errors, and after their lease expired; any other job is marked failed
+    rather than risk sending it twice.
+    """
+
+    def __init__(self, path=JOB_QUEUE_PATH, workers=JOB_WORKERS, max_attempts=JOB_MAX_ATTEMPTS,
+                 lease_seconds=JOB_LEASE_SECONDS, enabled=ASYNC_SIDE_EFFECTS):
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.enabled = enabled
+        self._handlers = {}
+        self._idempotent = set()
+        self._conn = None
+        self._conn_lock = threading.Lock()
+        self._tasks = []
+        self._db = None
+        self._wakeup = asyncio.Event()
+        self._finished = asyncio.Event()
+
+    def register(self, kind, handler, idempotent=False):
+        """Register `async handler(payload, db)` for jobs of this kind
+
+        `idempotent` handlers must be safe to run again after an attempt
+        that may already have taken effect.
+        """
+        self._handlers[kind] = handler
+        if idempotent:
+            self._idempotent.add(kind)
+
+    async def start(self, db=None):
+        self._db = db
+        await asyncio.to_thread(self._connect)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def enqueue(self, key, kind, payload, user_id=None, chat_id=None):
+        """Add a job unless one with this idempotency key exists; return the job"""
+        job = await asyncio.to_thread(self._insert, key, kind, payload, user_id, chat_id)
+        self._wakeup.set()
+        return job
+
+    async def get(self, job_id):
+        return await asyncio.to_thread(self._select, job_id)
+
+    async def wait(self, job_ids, timeout=JOB_STREAM_WAIT):
+        """Yield each job once it has finished, until all are done or `timeout` passes"""
+        pending = set(job_ids)
+        deadline = time.monotonic() + timeout
+        while pending:
+            finished = self._finished
+            for job_id in list(pending):
+                job = await self.get(job_id)
+                if job is None or job['status'] in FINISHED:
+                    pending.discard(job_id)
+                    if job:
+                        yield job
+            remaining = deadline - time.monotonic()
+            if not pending or remaining <= 0:
+                return
+            try:
+                # Woken early by local workers; jobs run by other processes are polled
+                await asyncio.wait_for(finished.wait(), min(POLL_INTERVAL, remaining))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self):
+        while True:
+            wakeup = self._wakeup
+            job = await asyncio.to_thread(self._claim)
+            if job is None:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                if wakeup.is_set():
+                    self._wakeup = asyncio.Event()
+                continue
+            if job['status'] == 'failed':
+                self._notify_finished()
+                continue
+            await self._run(job)
+
+    async def _run(self, job):
+        handler = self._handlers.get(job['kind'])
+        try:
+            if handler is None:
+                raise LookupError(f"No handler for job kind {job['kind']}")
+            result = await handler(job['payload'], self._db)
+        except Exception as e:
+            retry = is_retryable(e, job['kind'] in self._idempotent) and job['attempts'] < self.max_attempts
+            delay = min(60, 2 ** (job['attempts'] - 1)) + random.random()
+            print(f"Job {job['id']} ({job['kind']}) attempt {job['attempts']} failed: {e}")
+            await asyncio.to_thread(self._fail, job['id'], str(e), delay if retry else None)
+            if retry:
+                return
+        else:
+            await asyncio.to_thread(self._complete, job['id'], result)
+        self._notify_finished()
+
+    def _notify_finished(self):
+        finished, self._finished = self._finished, asyncio.Event()
+        finished.set()
+
+    def _connect(self):
+        with self._conn_lock:
+            if self._conn is None:
+                conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=5)
+                conn.row_factory = sqlite3.Row
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.executescript(SCHEMA)
+                self._conn = conn
+            return self._conn
+
+    def _insert(self, key, kind, payload, user_id, chat_id):
+        conn = self._connect()
+        now = time.time()
+        with self._conn_lock:
+            conn.execute(
+                'INSERT OR IGNORE INTO jobs (id, kind, payload, user_id, chat_id, status, run_after, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, kind, json.dumps(payload), user_id, chat_id, 'queued', now, now, now),
+            )
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (key,)).fetchone()
+        return self._to_job(row)
+
+    def _select(self, job_id):
+        conn = self._connect()
+        with self._conn_lock:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._to_job(row) if row else None
+
+    def _claim(self):
+        conn = self._connect()
+        now = time.time()
+        with self._conn_lock:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE (status = 'queued' AND run_after <= ?) "
+                    "OR (status = 'running' AND lease_until < ?) ORDER BY run_after LIMIT 1",
+                    (now, now),
+                ).fetchone()
+                expired = row is not None and row['status'] == 'running'
+                if expired and row['kind'] not in self._idempotent:
+                    # The worker may have sent it before it died or stalled
+                    error = f"Lease expired during attempt {row['attempts']}; not retried as it may have been delivered"
+                    conn.execute(
+                        "UPDATE jobs SET status = 'failed', error = ?, lease_until = NULL, updated_at = ? WHERE id = ?",
+                        (error, now, row['id']),
+                    )
+                elif row is not None:
+                    conn.execute(
+                        "UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_until = ?, updated_at = ? WHERE id = ?",
+                        (now + self.lease_seconds, now, row['id']),
+                    )
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        if row is None:
+            return None
+        job = self._to_job(row)
+        if expired and job['kind'] not in self._idempotent:
+            print(f"Job {job['id']} ({job['kind']}) failed: {error}")
+            job['status'] = 'failed'
+            return job
+        job['attempts'] += 1
+        return job
+
+    def _complete(self, job_id, result):
+        with self._conn_lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'done', result = ?, error = NULL, lease_until = NULL, updated_at = ? WHERE id = ?",
+                (json.dumps(result, default=str), time.time(), job_id),
+            )
+
+    def _fail(self, job_id, error, retry_in):
+        now = time.time()
+        with self._conn_lock:
+            if retry_in is None:
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, lease_until = NULL, updated_at = ? WHERE id = ?",
+                    (error, now, job_id),
+                )
+            else:
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'queued', error = ?, run_after = ?, lease_until = NULL, updated_at = ? WHERE id = ?",
+                    (error, now + retry_in, now, job_id),
+                )
+
+    @staticmethod
+    def _to_job(row):
+        return {
+            'id': row['id'],
+            'kind': row['kind'],
+            'payload': json.loads(row['payload']),
+            'user_id': row['user_id'],
+            'chat_id': row['chat_id'],
+            'status': row['status'],
+            'attempts': row['attempts'],
+            'result': json.loads(row['result']) if row['result'] else None,
+            'error': row['error'],
+        }
+
+
+job_queue = JobQueue()
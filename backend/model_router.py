@@ -0,0 +1,110 @@
+import os
+import re
+from dataclasses import dataclass
+from telemetry import registry, annotate
+
+# Set MODEL_ROUTING=0 to send every turn to the full tool-enabled agent
+MODEL_ROUTING = os.getenv('MODEL_ROUTING', '1') != '0'
+FAST_MODEL = os.getenv('FAST_MODEL', 'gemini-2.5-flash-lite')
+# Score at which a turn goes to the tools route; see TOOL_SIGNALS
+ROUTER_TOOL_THRESHOLD = float(os.getenv('ROUTER_TOOL_THRESHOLD', '1'))
+# Prompts up to this many words that answer a question from the agent go to
+# the tools route; drafts end with one ("Shall I send it?")
+ROUTER_FOLLOW_UP_WORDS = int(os.getenv('ROUTER_FOLLOW_UP_WORDS', '8'))
+
+# The chat route answers with exactly this when the turn needs a tool
+ESCALATE_REPLY = 'NEEDS_TOOLS'
+
+# (name, pattern, weight): email and calendar words are enough on their own,
+# dates and times only together with something else
+TOOL_SIGNALS = [
+    ('email', re.compile(r"\b(e-?mails?|mail|send|sent|reply|forward|cc|bcc|inbox|subject|attach\w*|newsletter)\b"), 1.0),
+    ('calendar', re.compile(r"\b(schedul\w*|calendar|meetings?|meet|events?|invit\w*|appointments?|book|reschedul\w*|remind\w*|availab\w*|free (slot|time)|busy|recurring)\b"), 1.0),
+    ('address', re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+"), 1.0),
+    ('date', re.compile(r"\b(today|tonight|tomorrow|next (week|month)|(mon|tues|wednes|thurs|fri|satur|sun)day|\d{1,2}(:\d{2})?\s*(am|pm)|\d{4}-\d{2}-\d{2})\b"), 0.5),
+]
+
+ROUTES = registry.counter('agent_routes_total', 'Agent turns by model route and the reason it was chosen', ['route', 'reason'])
+ROUTE_SECONDS = registry.histogram('agent_route_seconds', 'Model time of an agent turn by route', ['route'])
+ROUTE_TOKENS = registry.counter('agent_route_tokens_total', 'LLM tokens used by route', ['route', 'type'])
+
+
+@dataclass
+class Route:
+    name: str  # 'chat' or 'tools'
+    reason: str
+    score: float = 0.0
+
+
+def score(prompt):
+    """Sum of the weights of the TOOL_SIGNALS found in the prompt, and their names"""
+    text = prompt.lower()
+    matched = [name for name, pattern, _ in TOOL_SIGNALS if pattern.search(text)]
+    return sum(weight for name, _, weight in TOOL_SIGNALS if name in matched), matched
+
+
+def is_follow_up(prompt, history):
+    """Whether a short prompt answers a question the agent just asked ("yes, send it")"""
+    if not history or len(prompt.split()) > ROUTER_FOLLOW_UP_WORDS:
+        return False
+    from pydantic_ai.messages import ModelResponse, TextPart
+    last = next((m for m in reversed(history) if isinstance(m, ModelResponse)), None)
+    text = ''.join(p.content for p in last.parts if isinstance(p, TextPart)) if last else ''
+    return text.rstrip().endswith('?')
+
+
+def route(prompt, history):
+    """Pick the route for a turn without calling a model"""
+    if not MODEL_ROUTING:
+        chosen = Route('tools', 'disabled')
+    else:
+        total, matched = score(prompt)
+        if total >= ROUTER_TOOL_THRESHOLD:
+            chosen = Route('tools', '+'.join(matched), total)
+        elif is_follow_up(prompt, history):
+            chosen = Route('tools', 'follow_up', total)
+        else:
+            chosen = Route('chat', 'no_tool_signal', total)
+    ROUTES.inc(route=chosen.name, reason=chosen.reason)
+    annotate(route=chosen.name, route_reason=chosen.reason)
+    return chosen
+
+
+def escalate(chosen):
+    """The chat route asked for tools; hand the turn to the tools route"""
+    ROUTES.inc(route='tools', reason='escalated')
+    annotate(route='tools', route_reason='escalated')
+    return Route('tools', 'escalated', chosen.score)
+
+
+class ReplyHold:
+    """Holds back streamed text while it could still be exactly `reply`.
+
+    Surrounding whitespace is ignored, as in `needs_tools`. `feed` returns
+    the text to send now, if any; `finish` returns what is left unless it
+    was the reply.
+    """
+
+    def __init__(self, reply=ESCALATE_REPLY):
+        self.reply = reply
+        self._held = []
+
+    def feed(self, content):
+        if self._held is None:
+            return content
+        self._held.append(content)
+        if self.reply.startswith(''.join(self._held).strip()):
+            return None
+        content, self._held = ''.join(self._held), None
+        return content
+
+    def finish(self):
+        held, self._held = ''.join(self._held or []), None
+        return None if held.strip() == self.reply else held or None
+
+
+def record(chosen, usage, seconds):
+    """Count one finished run's latency and tokens against its route"""
+    ROUTE_SECONDS.observe(seconds, route=chosen.name)
+    ROUTE_TOKENS.inc(usage.input_tokens or 0, route=chosen.name, type='input')
+    ROUTE_TOKENS.inc(usage.output_tokens or 0, route=chosen.name, type='output')
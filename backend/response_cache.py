@@ -0,0 +1,228 @@
+import os
+import json
+import math
+import time
+import hashlib
+from dataclasses import replace
+from collections import OrderedDict
+from datetime import datetime, timezone
+from pydantic_ai.messages import (
+    ModelMessagesTypeAdapter,
+    ModelRequest,
+    ModelResponse,
+    TextPart,
+    ToolCallPart,
+    UserPromptPart,
+)
+from pydantic_ai.usage import RequestUsage, RunUsage
+from telemetry import registry
+
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '1024'))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '3600'))
+RESPONSE_CACHE_EMBEDDING_MODEL = os.getenv('RESPONSE_CACHE_EMBEDDING_MODEL', '')
+RESPONSE_CACHE_SIMILARITY = float(os.getenv('RESPONSE_CACHE_SIMILARITY', '0.95'))
+
+LOOKUPS = registry.counter('response_cache_lookups_total', 'Response cache lookups', ['result'])
+SAVED_SECONDS = registry.counter('response_cache_saved_seconds_total', 'Model time skipped by response cache hits')
+
+
+def normalize_prompt(prompt):
+    return ' '.join(prompt.lower().split()).rstrip('?!. ')
+
+
+def context_hash(history):
+    """Hash everything the model is sent of a history: each part's kind, tool name and content, not timestamps"""
+    digest = hashlib.sha256()
+    for message in history:
+        digest.update(message.kind.encode() + b'\0')
+        for part in message.parts:
+            content = getattr(part, 'content', None)
+            if content is None:
+                content = getattr(part, 'args', None)
+            if not isinstance(content, str):
+                content = json.dumps(content, default=str, sort_keys=True)
+            digest.update(f"{part.part_kind}\0{getattr(part, 'tool_name', '')}\0{content}\0".encode())
+    return digest.hexdigest()
+
+
+def calls_tools(messages):
+    return any(isinstance(p, ToolCallPart) for m in messages if isinstance(m, ModelResponse) for p in m.parts)
+
+
+def final_text(messages):
+    for message in reversed(messages):
+        if isinstance(message, ModelResponse):
+            text = ''.join(p.content for p in message.parts if isinstance(p, TextPart))
+            if text:
+                return text
+    return ''
+
+
+def cosine(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class CachedEntry:
+    def __init__(self, messages_json, output, model_seconds, embedding=None, user_id=None):
+        self.messages_json = messages_json
+        self.output = output
+        self.model_seconds = model_seconds
+        self.embedding = embedding
+        self.user_id = user_id
+        self.created_at = time.monotonic()
+        self.size = len(messages_json) + len(output) + (len(embedding) * 8 if embedding else 0)
+
+
+class CachedResult:
+    """Stands in for an agent run result when a turn is answered from the cache"""
+
+    def __init__(self, history, new_messages, output):
+        self._history = list(history)
+        self._new_messages = new_messages
+        self.output = output
+        self.usage = RunUsage()
+
+    def new_messages(self):
+        return list(self._new_messages)
+
+    def all_messages(self):
+        return self._history + self._new_messages
+
+
+class Lookup:
+    """Everything computed for a lookup, reused when the miss is stored"""
+
+    def __init__(self, key, embedding=None):
+        self.key = key
+        self.embedding = embedding
+
+
+class ResponseCache:
+    """Cache of answers to turns that did not call any tool.
+
+    Entries are keyed on the user, the normalized prompt and a hash of the
+    whole (compacted) history the model would be sent, so an answer is only
+    reused for the same user in the same conversation state, e.g. "what is
+    12*7" asked at the start of each of their chats. A turn whose run called a tool is never
+    stored, because its answer depends on calendar state, the clock or an
+    action it performed. When RESPONSE_CACHE_EMBEDDING_MODEL is set, an exact
+    miss falls back to the most similar cached prompt of the same user with
+    the same history, above RESPONSE_CACHE_SIMILARITY.
+    """
+
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE, max_bytes=RESPONSE_CACHE_MAX_BYTES, ttl=RESPONSE_CACHE_TTL,
+                 embedding_model=RESPONSE_CACHE_EMBEDDING_MODEL, similarity=RESPONSE_CACHE_SIMILARITY):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.similarity = similarity
+        self.embedding_model = embedding_model
+        self._embedder = None
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.ttl > 0
+
+    async def lookup(self, prompt, history, user_id=None, scope=None):
+        """Return (CachedResult or None, Lookup)
+
+        `scope` narrows the context an answer is reused in, e.g. to the
+        user's current date when the instructions mention it.
+        """
+        context = context_hash(history)
+        if scope:
+            context = f"{context}:{scope}"
+        key = (user_id, normalize_prompt(prompt), context)
+        lookup = Lookup(key)
+
+        entry = self._get(key)
+        if entry is None and self.embedding_model:
+            lookup.embedding = await self._embed(key[1])
+            entry = self._nearest(lookup.embedding, context, user_id)
+        if entry is None:
+            LOOKUPS.inc(result='miss')
+            return None, lookup
+
+        LOOKUPS.inc(result='hit')
+        SAVED_SECONDS.inc(entry.model_seconds)
+        return CachedResult(history, self._restore(entry, prompt), entry.output), lookup
+
+    def store(self, lookup, result, model_seconds, user_id=None):
+        """Cache a finished run unless it called a tool"""
+        new_messages = result.new_messages()
+        if calls_tools(new_messages):
+            LOOKUPS.inc(result='bypass')
+            return
+        output = final_text(new_messages)
+        if not output:
+            return
+        messages_json = ModelMessagesTypeAdapter.dump_json(new_messages)
+        self._put(lookup.key, CachedEntry(messages_json, output, model_seconds, lookup.embedding, user_id))
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.created_at > self.ttl:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _nearest(self, embedding, context, user_id):
+        if embedding is None:
+            return None
+        best_key, best_score = None, self.similarity
+        for key, entry in self._entries.items():
+            if key[0] != user_id or key[2] != context or entry.embedding is None:
+                continue
+            score = cosine(embedding, entry.embedding)
+            if score >= best_score:
+                best_key, best_score = key, score
+        return self._get(best_key) if best_key else None
+
+    async def _embed(self, text):
+        try:
+            if self._embedder is None:
+                from pydantic_ai.embeddings import Embedder
+                self._embedder = Embedder(self.embedding_model)
+            result = await self._embedder.embed_query(text)
+            return list(result.embeddings[0])
+        except Exception as e:
+            print(f"Response cache embedding failed: {e}")
+            return None
+
+    def _put(self, key, entry):
+        if entry.size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        self._bytes += entry.size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    @staticmethod
+    def _restore(entry, prompt):
+        """Replay the cached messages for this prompt, stamped as new"""
+        now = datetime.now(timezone.utc)
+        messages = []
+        for message in ModelMessagesTypeAdapter.validate_json(entry.messages_json):
+            if isinstance(message, ModelRequest):
+                parts = [replace(p, content=prompt, timestamp=now) if isinstance(p, UserPromptPart) else p for p in message.parts]
+                messages.append(replace(message, parts=parts, timestamp=now, run_id=None))
+            else:
+                messages.append(replace(message, usage=RequestUsage(), timestamp=now, run_id=None))
+        return messages
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,115 @@
+import os
+import time
+import asyncio
+from contextlib import contextmanager
+from collections import OrderedDict
+from telemetry import span
+
+SERVICE_CACHE_SIZE = int(os.getenv('SERVICE_CACHE_SIZE', '256'))
+SERVICE_CACHE_TTL = float(os.getenv('SERVICE_CACHE_TTL', '300'))
+
+
+def is_auth_error(error):
+    """Whether Google answered 401: the client's token was revoked or replaced"""
+    return getattr(getattr(error, 'resp', None), 'status', None) == 401
+
+
+class CachedService:
+    """An authenticated Google API client plus what it was built from"""
+
+    def __init__(self, service, creds, token):
+        self.service = service
+        self.creds = creds
+        self.token = token
+        self.loaded_at = time.monotonic()
+
+    def touch(self):
+        self.loaded_at = time.monotonic()
+        return self
+
+    def is_fresh(self, ttl):
+        return bool(self.creds and self.creds.valid) and time.monotonic() - self.loaded_at < ttl
+
+
+class ServiceCache:
+    """Bounded LRU/TTL cache of Google API clients keyed by (user_id, service).
+
+    An entry is served without touching Firestore while its credentials are
+    valid and it is younger than the TTL. After that the loader re-reads the
+    stored token and either keeps the existing client (token unchanged) or
+    rebuilds it. Loads for the same key are single-flight, so concurrent tool
+    calls for one user share a single Firestore read and token refresh.
+    A client is dropped when its load fails or Google rejects it with 401,
+    so the next call reads the stored token again.
+    """
+
+    def __init__(self, max_size=SERVICE_CACHE_SIZE, ttl=SERVICE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._locks = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get_or_load(self, user_id, service_name, loader):
+        """Return a cached client, calling `loader(user_id, stale_entry)` on a miss"""
+        key = (user_id, service_name)
+        entry = self._get_fresh(key)
+        if entry:
+            self.hits += 1
+            return entry.service
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            entry = self._get_fresh(key)
+            if entry:
+                self.hits += 1
+                return entry.service
+
+            self.misses += 1
+            try:
+                with span('service_load', service=service_name):
+                    entry = await loader(user_id, self._entries.get(key))
+            except BaseException:
+                # The stored token is unusable; neither the old client nor the lock is kept
+                self._entries.pop(key, None)
+                if self._locks.get(key) is lock:
+                    del self._locks[key]
+                raise
+            self._store(key, entry)
+            return entry.service
+
+    def invalidate(self, user_id, service_name=None):
+        """Drop cached clients for a user, e.g. after their stored token changed"""
+        for key in list(self._entries):
+            if key[0] == user_id and (service_name is None or key[1] == service_name):
+                del self._entries[key]
+
+    @contextmanager
+    def invalidate_on_auth_error(self, user_id, service_name):
+        """Drop the user's client when a call made with it gets 401"""
+        try:
+            yield
+        except Exception as e:
+            if is_auth_error(e):
+                self.invalidate(user_id, service_name)
+            raise
+
+    def _get_fresh(self, key):
+        entry = self._entries.get(key)
+        if entry and entry.is_fresh(self.ttl):
+            self._entries.move_to_end(key)
+            return entry
+        return None
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            evicted, _ = self._entries.popitem(last=False)
+            lock = self._locks.get(evicted)
+            if lock and not lock.locked():
+                del self._locks[evicted]
+
+
+service_cache = ServiceCache()
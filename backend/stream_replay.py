@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+from collections import OrderedDict, deque
+from telemetry import registry
+
+# Events of one run kept for clients that reconnect
+STREAM_REPLAY_EVENTS = int(os.getenv('STREAM_REPLAY_EVENTS', '2000'))
+# Seconds a finished run's events stay available
+STREAM_REPLAY_TTL = float(os.getenv('STREAM_REPLAY_TTL', '300'))
+# Chats whose latest run is kept
+STREAM_REPLAY_CHATS = int(os.getenv('STREAM_REPLAY_CHATS', '1000'))
+
+RESUMES = registry.counter('sse_resumes_total', 'Reconnects with Last-Event-ID by result', ['result'])
+
+
+class StreamBuffer:
+    """The SSE events of one agent run, numbered from 1.
+
+    The run appends events whether or not anyone is listening; readers
+    `follow` the buffer from any event still in it. Only the last
+    STREAM_REPLAY_EVENTS events are kept.
+    """
+
+    def __init__(self, chat_id, user_id, max_events=STREAM_REPLAY_EVENTS):
+        self.id = uuid.uuid4().hex[:12]
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.events = deque(maxlen=max_events)
+        self.last_seq = 0
+        self.done = False
+        self.finished_at = None
+        self._changed = asyncio.Event()
+
+    def append(self, event):
+        self.last_seq += 1
+        self.events.append((self.last_seq, json.dumps(event, default=str)))
+        self._notify()
+
+    def close(self):
+        self.done = True
+        self.finished_at = time.monotonic()
+        self._notify()
+
+    def event_id(self, seq):
+        return f'{self.id}-{seq}'
+
+    async def follow(self, after=0):
+        """Yield SSE-formatted events after number `after`, waiting for new ones until the run ends.
+
+        Raises LookupError when events the reader has not seen were already
+        dropped from the buffer.
+        """
+        while True:
+            changed = self._changed
+            if self.events and self.events[0][0] > after + 1:
+                raise LookupError(f"Events after {self.event_id(after)} are no longer available")
+            for seq, data in list(self.events):
+                if seq > after:
+                    yield f"id: {self.event_id(seq)}\ndata: {data}\n\n"
+                    after = seq
+            if self.done and after >= self.last_seq:
+                return
+            await changed.wait()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+
+class StreamReplay:
+    """The latest run's StreamBuffer per chat, and the tasks running them.
+
+    Runs execute as tasks of their own, so a client that disconnects does
+    not stop its run; it reconnects with `Last-Event-ID` and `resume` finds
+    where it left off. Buffers live in this process only.
+    """
+
+    def __init__(self, max_chats=STREAM_REPLAY_CHATS, ttl=STREAM_REPLAY_TTL):
+        self.max_chats = max_chats
+        self.ttl = ttl
+        self._buffers = OrderedDict()
+        self._tasks = set()
+
+    def open(self, chat_id, user_id):
+        """A new buffer for a run in this chat, replacing the previous run's"""
+        self._prune()
+        buffer = StreamBuffer(chat_id, user_id)
+        self._buffers[chat_id] = buffer
+        self._buffers.move_to_end(chat_id)
+        return buffer
+
+    def run(self, coro):
+        """Run `coro` in the background, independent of the request that started it"""
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def resume(self, chat_id, user_id, last_event_id):
+        """Return (buffer, seq) to continue a stream after `last_event_id`; raises LookupError"""
+        run_id, _, seq = last_event_id.rpartition('-')
+        buffer = self._buffers.get(chat_id)
+        if buffer is None or buffer.id != run_id or buffer.user_id != user_id or not seq.isdigit():
+            RESUMES.inc(result='expired')
+            raise LookupError(f"Stream {last_event_id} is no longer available")
+        RESUMES.inc(result='resumed')
+        return buffer, int(seq)
+
+    async def stop(self):
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _prune(self):
+        now = time.monotonic()
+        for chat_id, buffer in list(self._buffers.items()):
+            if buffer.done and now - buffer.finished_at > self.ttl:
+                del self._buffers[chat_id]
+        while len(self._buffers) >= self.max_chats:
+            self._buffers.popitem(last=False)
+
+
+stream_replay = StreamReplay()
@@ -0,0 +1,243 @@
+import os
+import sys
+import json
+import time
+import uuid
+import bisect
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+logger = logging.getLogger('worme.trace')
+if os.getenv('TRACE_LOG', '1') == '1' and not logger.handlers:
+    logger.addHandler(logging.StreamHandler(sys.stderr))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def _render_value(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, [('le', _format_value(float(bound)))])
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+        lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Registry:
+    """Holds metrics and renders them in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, *args, **kwargs):
+        return self._add(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self._add(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self._add(Histogram(*args, **kwargs))
+
+    def add_collector(self, collector):
+        """Register a callback run before each scrape, e.g. to copy pool stats into gauges"""
+        self._collectors.append(collector)
+
+    def render(self):
+        for collector in self._collectors:
+            collector()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+
+registry = Registry()
+
+REQUESTS = registry.counter('agent_requests_total', 'Agent turns by outcome', ['status'])
+REQUEST_SECONDS = registry.histogram('agent_request_seconds', 'Wall time of a whole /agent turn')
+STAGE_SECONDS = registry.histogram('agent_stage_seconds', 'Time spent per pipeline stage', ['stage'])
+TOKENS = registry.counter('agent_tokens_total', 'LLM tokens used', ['type'])
+TURN_TOKENS = registry.histogram(
+    'agent_turn_tokens', 'LLM tokens per turn', ['type'],
+    buckets=(500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000),
+)
+
+
+class Trace:
+    def __init__(self, name):
+        self.name = name
+        self.trace_id = uuid.uuid4().hex
+        self.started = time.perf_counter()
+        self.spans = []
+        self.attributes = {}
+
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+def _reset(var, token):
+    # An async generator may be resumed from another task's context
+    try:
+        var.reset(token)
+    except ValueError:
+        var.set(token.old_value if token.old_value is not contextvars.Token.MISSING else None)
+
+
+@contextmanager
+def trace(name, **attributes):
+    """Start a per-request trace; spans opened inside it are attached to it"""
+    current = Trace(name)
+    current.attributes.update(attributes)
+    token = _current_trace.set(current)
+    status = 'ok'
+    try:
+        yield current
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        _reset(_current_trace, token)
+        elapsed = time.perf_counter() - current.started
+        REQUESTS.inc(status=status)
+        REQUEST_SECONDS.observe(elapsed)
+        logger.info(json.dumps({
+            'trace': current.name,
+            'trace_id': current.trace_id,
+            'status': status,
+            'duration_ms': round(elapsed * 1000, 2),
+            **current.attributes,
+            'spans': current.spans,
+        }, default=str))
+
+
+@contextmanager
+def span(stage, **attributes):
+    """Time one pipeline stage, recording it in the stage histogram and the current trace"""
+    current = _current_trace.get()
+    parent = _current_span.get()
+    token = _current_span.set(stage)
+    started = time.perf_counter()
+    error = None
+    try:
+        yield attributes
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        _reset(_current_span, token)
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        if current is not None:
+            record = {
+                'stage': stage,
+                'start_ms': round((started - current.started) * 1000, 2),
+                'duration_ms': round(elapsed * 1000, 2),
+            }
+            if parent:
+                record['parent'] = parent
+            if error:
+                record['error'] = error
+            record.update(attributes)
+            current.spans.append(record)
+
+
+def annotate(**attributes):
+    """Attach attributes to the current trace, if any"""
+    current = _current_trace.get()
+    if current is not None:
+        current.attributes.update(attributes)
+
+
+def record_usage(usage):
+    """Count the token usage of one agent run and attach it to the current trace"""
+    input_tokens = usage.input_tokens or 0
+    output_tokens = usage.output_tokens or 0
+    TOKENS.inc(input_tokens, type='input')
+    TOKENS.inc(output_tokens, type='output')
+    TURN_TOKENS.observe(input_tokens, type='input')
+    TURN_TOKENS.observe(output_tokens, type='output')
+    annotate(input_tokens=input_tokens, output_tokens=output_tokens, model_requests=usage.requests)
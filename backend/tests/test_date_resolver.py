@@ -0,0 +1,45 @@
+import datetime
+import pytest
+from date_resolver import DateResolutionError, normalize_timezone, zone, resolve_event_fields
+
+
+def offset(value):
+    return datetime.datetime(2026, 1, 15, tzinfo=zone(normalize_timezone(value))).utcoffset()
+
+
+@pytest.mark.parametrize('value, hours', [
+    ('GMT+7', 7), ('gmt-5', -5), ('UTC+7', 7), ('UTC-07:00', -7), ('+7', 7), ('GMT+0', 0),
+])
+def test_whole_hour_offsets_keep_their_sign(value, hours):
+    assert offset(value) == datetime.timedelta(hours=hours)
+
+
+def test_gmt_and_utc_prefixes_agree():
+    assert normalize_timezone('GMT+7') == normalize_timezone('UTC+7') == 'Etc/GMT-7'
+
+
+def test_explicit_etc_zone_is_unchanged():
+    assert normalize_timezone('Etc/GMT+7') == 'Etc/GMT+7'
+
+
+@pytest.mark.parametrize('value, delta', [
+    ('UTC+05:30', datetime.timedelta(hours=5, minutes=30)),
+    ('+05:45', datetime.timedelta(hours=5, minutes=45)),
+    ('GMT-03:30', -datetime.timedelta(hours=3, minutes=30)),
+    ('utc+0930', datetime.timedelta(hours=9, minutes=30)),
+])
+def test_partial_hour_offsets_are_fixed_offsets(value, delta):
+    assert offset(value) == delta
+
+
+def test_fixed_offset_event_times():
+    fields = resolve_event_fields({'start_date': '2026-10-20T09:00', 'end_date': '1 hour', 'timezone': '+05:45'})
+    assert fields['timezone'] == 'UTC+05:45'
+    assert fields['start_date'] == '2026-10-20T09:00:00+05:45'
+    assert fields['end_date'] == '2026-10-20T10:00:00+05:45'
+
+
+@pytest.mark.parametrize('value', ['UTC+15', '+05:75'])
+def test_out_of_range_offsets_are_rejected(value):
+    with pytest.raises(DateResolutionError):
+        normalize_timezone(value)
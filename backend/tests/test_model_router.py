@@ -0,0 +1,35 @@
+import pytest
+from model_router import ReplyHold, ESCALATE_REPLY
+
+
+def stream(chunks):
+    hold = ReplyHold(ESCALATE_REPLY)
+    sent = [text for text in map(hold.feed, chunks) if text]
+    if (rest := hold.finish()):
+        sent.append(rest)
+    return sent
+
+
+@pytest.mark.parametrize('chunks', [
+    ['NEEDS_TOOLS'],
+    ['NEEDS_TOOLS\n'],
+    ['NEEDS_', 'TOOLS', '\n'],
+    ['  NEEDS', '_TOOLS  \n\n'],
+])
+def test_escalation_sentinel_is_never_sent(chunks):
+    assert stream(chunks) == []
+
+
+def test_text_is_released_once_it_stops_matching():
+    assert stream(['NEED', 'S a moment', ' to think']) == ['NEEDS a moment', ' to think']
+
+
+def test_ordinary_reply_is_sent_at_once():
+    hold = ReplyHold(ESCALATE_REPLY)
+    assert hold.feed('Hello') == 'Hello'
+    assert hold.feed(' there') == ' there'
+    assert hold.finish() is None
+
+
+def test_reply_that_is_only_a_prefix_is_sent_at_the_end():
+    assert stream(['NEEDS']) == ['NEEDS']
@@ -1,45 +1,78 @@
 import os
 import base64
-from cryptography.fernet import Fernet
+from functools import lru_cache
+from cryptography.fernet import Fernet, MultiFernet
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from dotenv import load_dotenv
 
 load_dotenv()
 
+KDF_ITERATIONS = 100000
+
+
+@lru_cache(maxsize=None)
+def derive_key(password: bytes, salt: bytes) -> bytes:
+    """Run PBKDF2 once per (password, salt) and remember the result for the process"""
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt,
+        iterations=KDF_ITERATIONS,
+    )
+    return base64.urlsafe_b64encode(kdf.derive(password))
+
+
 class TokenEncryption:
+    """Encrypts service tokens with the current SECRET_KEY.
+
+    Older keys listed in PREVIOUS_SECRET_KEYS (comma separated, newest first)
+    are still accepted for decryption, so SECRET_KEY can be rotated without
+    re-encrypting every stored token up front.
+    """
+
     def __init__(self):
         self.password = os.getenv('SECRET_KEY', 'default-secret-key').encode()
-        self.salt = b'stable_salt_for_tokens'  
-        
-    def _get_key(self):
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=self.salt,
-            iterations=100000,
-        )
-        key = base64.urlsafe_b64encode(kdf.derive(self.password))
-        return key
-    
+        self.previous_passwords = [
+            p.strip().encode() for p in os.getenv('PREVIOUS_SECRET_KEYS', '').split(',') if p.strip()
+        ]
+        self.salt = b'stable_salt_for_tokens'
+        self._fernet = None
+
+    def _get_key(self, password=None):
+        return derive_key(password or self.password, self.salt)
+
+    def _get_fernet(self) -> MultiFernet:
+        if self._fernet is None:
+            passwords = [self.password, *self.previous_passwords]
+            self._fernet = MultiFernet([Fernet(self._get_key(p)) for p in passwords])
+        return self._fernet
+
     def encrypt_token(self, token_json: str) -> str:
         """Encrypt a token JSON string"""
         try:
-            f = Fernet(self._get_key())
-            encrypted_data = f.encrypt(token_json.encode())
+            encrypted_data = self._get_fernet().encrypt(token_json.encode())
             return base64.urlsafe_b64encode(encrypted_data).decode()
         except Exception as e:
             raise Exception(f"Failed to encrypt token: {e}")
-    
+
     def decrypt_token(self, encrypted_token: str) -> str:
         """Decrypt a token and return JSON string"""
         try:
-            f = Fernet(self._get_key())
             encrypted_data = base64.urlsafe_b64decode(encrypted_token.encode())
-            decrypted_data = f.decrypt(encrypted_data)
+            decrypted_data = self._get_fernet().decrypt(encrypted_data)
             return decrypted_data.decode()
         except Exception as e:
             raise Exception(f"Failed to decrypt token: {e}")
 
+    def rotate_token(self, encrypted_token: str) -> str:
+        """Re-encrypt a token under the current SECRET_KEY"""
+        try:
+            encrypted_data = base64.urlsafe_b64decode(encrypted_token.encode())
+            rotated_data = self._get_fernet().rotate(encrypted_data)
+            return base64.urlsafe_b64encode(rotated_data).decode()
+        except Exception as e:
+            raise Exception(f"Failed to rotate token: {e}")
+
 
-token_encryptor = TokenEncryption()
\ No newline at end of file
+token_encryptor = TokenEncryption()
@@ -0,0 +1,57 @@
+import os
+import json
+import asyncio
+import weakref
+
+TOOL_CONCURRENCY_PER_USER = int(os.getenv('TOOL_CONCURRENCY_PER_USER', '4'))
+
+
+class UserLimits:
+    """Per-user semaphores bounding concurrent side-effecting tool calls.
+
+    pydantic-ai runs the tool calls of one model response concurrently; this
+    keeps a single user (across all of their open chats) from having more
+    than `limit` Gmail/Calendar writes in flight. Semaphores are held weakly,
+    so idle users cost nothing.
+    """
+
+    def __init__(self, limit=TOOL_CONCURRENCY_PER_USER):
+        self.limit = limit
+        self._semaphores = weakref.WeakValueDictionary()
+
+    def get(self, user_id):
+        semaphore = self._semaphores.get(user_id)
+        if semaphore is None:
+            semaphore = self._semaphores[user_id] = asyncio.Semaphore(self.limit)
+        return semaphore
+
+
+class TurnCalls:
+    """Side-effecting tool calls made during one agent run.
+
+    Calls with the same tool name and arguments share one execution, so a
+    model that repeats a send_message or create_event within a turn (in one
+    response or across steps) gets the first call's result instead of
+    sending a second email or creating a duplicate event.
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+        self._calls = {}
+
+    async def run(self, tool, args, user_id, call):
+        key = (tool, json.dumps(args, sort_keys=True, default=str))
+        task = self._calls.get(key)
+        if task is None:
+            task = self._calls[key] = asyncio.ensure_future(self._limited(user_id, call))
+        else:
+            print(f"Skipping duplicate {tool} call in this turn")
+        # Shielded so a cancelled duplicate does not cancel the shared call
+        return await asyncio.shield(task)
+
+    async def _limited(self, user_id, call):
+        async with self.limits.get(user_id):
+            return await call()
+
+
+user_limits = UserLimits()
@@ -0,0 +1,83 @@
+import os
+import time
+import asyncio
+import importlib
+from telemetry import registry, span
+
+STARTUP_WARMUP = os.getenv('STARTUP_WARMUP', 'blocking')
+
+# Modules the first request would otherwise import: the agent (pydantic-ai and
+# the tool modules) and the google-auth transports the tools load lazily
+WARMUP_IMPORTS = (
+    'workflow_agent',
+    'google.oauth2.credentials',
+    'google.auth.transport.requests',
+    'google_auth_httplib2',
+    'googleapiclient.discovery',
+)
+
+STEP_SECONDS = registry.gauge('startup_warmup_seconds', 'Time taken by each start-up warm-up step', ['step'])
+
+
+async def import_modules(names=WARMUP_IMPORTS):
+    for name in names:
+        await asyncio.to_thread(importlib.import_module, name)
+
+
+class Warmup:
+    """Start-up work that must finish before the API can serve agent requests.
+
+    Steps are `(name, async fn)` pairs run in order. With
+    STARTUP_WARMUP=blocking the lifespan hook waits for them before the
+    server accepts connections. With STARTUP_WARMUP=background the server
+    starts listening right away, `/ready` answers 503 until every step has
+    finished and `/agent` requests wait for the warm-up.
+    """
+
+    def __init__(self, background=STARTUP_WARMUP == 'background'):
+        self.background = background
+        self.steps = {}
+        self._task = None
+
+    @property
+    def ready(self):
+        return bool(self.steps) and all(step['status'] == 'done' for step in self.steps.values())
+
+    def start(self, steps):
+        self.steps = {name: {'status': 'pending', 'seconds': None} for name, _ in steps}
+        self._task = asyncio.create_task(self._run(steps))
+        return self._task
+
+    async def wait(self):
+        """Wait for the warm-up to finish; return whether it succeeded"""
+        if self._task is not None:
+            await asyncio.shield(self._task)
+        return self.ready
+
+    async def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def status(self):
+        return {'ready': self.ready, 'steps': self.steps}
+
+    async def _run(self, steps):
+        for name, step in steps:
+            self.steps[name]['status'] = 'running'
+            started = time.perf_counter()
+            try:
+                with span('warmup', step=name):
+                    await step()
+            except Exception as e:
+                print(f"Warm-up step {name} failed: {e}")
+                self.steps[name]['status'] = 'failed'
+                self.steps[name]['error'] = str(e)
+                return
+            finally:
+                self.steps[name]['seconds'] = round(time.perf_counter() - started, 3)
+                STEP_SECONDS.set(self.steps[name]['seconds'], step=name)
+            self.steps[name]['status'] = 'done'
+
+
+warmup = Warmup()
@@ -1,12 +1,23 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError, ValidationInfo, model_validator
 from pydantic_ai import Agent, RunContext
+from pydantic_ai.messages import PartStartEvent, PartDeltaEvent, TextPart, TextPartDelta, FunctionToolCallEvent, FunctionToolResultEvent, ToolReturnPart, ModelRequest, SystemPromptPart
 from typing import Union, Literal, Optional
 import os
 from dotenv import load_dotenv
-from email_tool import gmail_send_message
+from email_tool import gmail_send_message, gmail_send_bulk, gmail_deliver, resolve_attachments
 import asyncio
-from calendar_tool import create_calendar_event
+from calendar_tool import create_calendar_event, find_free_slots, check_conflicts, event_id_for
+from job_queue import job_queue
+from tool_calls import TurnCalls, user_limits
+from history_compaction import history_compactor
+from telemetry import span, annotate, record_usage
+from response_cache import response_cache
+import model_router
+from model_router import FAST_MODEL, ESCALATE_REPLY
+from date_resolver import DateResolutionError, resolve_event_fields, resolve_window, normalize_attendees, user_timezone, current_date_instructions, current_date_scope, zone
 import datetime 
+import time
+from dataclasses import replace
 
 load_dotenv()
 x = os.getenv('GOOGLE_API_KEY')
@@ -21,13 +32,22 @@ class CalendarResponse(BaseModel):
     action_type: Literal["calendar"] = "calendar"
     title: str
     description: str
-    start_date: str = Field(description="ISO 8601 format with timezone: YYYY-MM-DDTHH:MM:SS+07:00")
-    end_date: str = Field(description="ISO 8601 format with timezone: YYYY-MM-DDTHH:MM:SS+07:00")
-    timezone: str = Field(default="Asia/Jakarta", description="IANA timezone name like 'Asia/Jakarta' (default), 'America/New_York', 'Europe/London'")
+    start_date: str = Field(description="ISO 8601 local time: YYYY-MM-DDTHH:MM:SS, or an expression like 'tomorrow 3pm'")
+    end_date: str = Field(description="ISO 8601 local time: YYYY-MM-DDTHH:MM:SS, or a duration like '1 hour'")
+    timezone: str = Field(default="Asia/Jakarta", description="IANA timezone name like 'Asia/Jakarta', 'America/New_York', 'Europe/London'; defaults to the user's timezone")
     location: Optional[str] = Field(default=None, description="Meeting location or address")
     attendees: list[str] = Field(default=[], description="List of email addresses for attendees")
     recurrence: Optional[str] = Field(default=None, description="RRULE format like 'RRULE:FREQ=DAILY;COUNT=2' or 'RRULE:FREQ=WEEKLY;BYDAY=MO,WE,FR'")
 
+    @model_validator(mode='before')
+    @classmethod
+    def resolve_dates(cls, data, info: ValidationInfo):
+        """Resolve relative dates, durations, timezone aliases and RRULEs; the context may carry the user's `timezone` and `now`"""
+        if isinstance(data, dict):
+            context = info.context or {}
+            data = resolve_event_fields(data, context.get('timezone'), context.get('now'))
+        return data
+
 class CombinedResponse(BaseModel):
     action: Literal['combined']
     email: Optional[EmailResponse] = None
@@ -40,10 +60,12 @@ prompt = """
 You are an AI agent that helps people simplify their workflow. 
     You can generate emails, send them, and also schedule things on Google Calendar. You can also act like a normal chatbot if the user just wants to chat. So when they ask math questions or general questions, just answer them directly.
     
-    Important: You have three main tools available:
+    Important: You have five main tools available:
     1. send_message - for sending emails
-    2. create_event - for creating calendar events
-    3. get_current_date - for getting the current date and time
+    2. send_bulk_message - for sending the same email to many recipients, each receiving their own copy
+    3. create_event - for creating calendar events
+    4. find_free_slot - for finding free time in the user's (and attendees') calendars
+    5. get_current_date - for the exact current time, only when it matters (today's date is already given to you)
 
     
     Based on the user's request, you should:
@@ -56,14 +78,15 @@ You are an AI agent that helps people simplify their workflow.
     - Make sure content is in HTML form for proper formatting
     - Use tags like <h2>, <p>, <strong>, <em>, <ul>, <li>, <br>
     - Always use the send_message tool when handling email requests
+    - When the same email goes to a list of people individually, call send_bulk_message once with all recipients instead of calling send_message for each
+    - To attach files, pass their file names in send_message's attachments; only attach files the user names
     
     Calendar Guidelines:
-    - Dates: Use ISO 8601 format with Indonesia timezone: YYYY-MM-DDTHH:MM:SS+07:00
-      Examples: '2025-05-28T09:00:00+07:00', '2026-12-25T14:30:00+07:00'
-      *If user says "tomorrow/next week" → calculate actual date through running get_current_date tool first then calculate date from there
-      *If user doesn't say year or month, like "31 August" or "This Sunday", always use get_current_date tool to know the date today in order to do date calculations
-    - Timezone: Default to Indonesia time, but support other IANA timezone names:
-      * 'Asia/Jakarta' (Indonesia Western Time - WIB) - DEFAULT
+    - Dates: Use ISO 8601 local time in the event's timezone: YYYY-MM-DDTHH:MM:SS
+      Examples: '2025-05-28T09:00:00', '2026-12-25T14:30:00'
+      *For "tomorrow", "next week", "31 August" or "This Sunday", work out the date from today's date given in your instructions
+    - Timezone: Default to the user's timezone given in your instructions, but support other IANA timezone names:
+      * 'Asia/Jakarta' (Indonesia Western Time - WIB)
       * 'Asia/Makassar' (Indonesia Central Time - WITA)  
       * 'Asia/Jayapura' (Indonesia Eastern Time - WIT)
       * 'America/New_York' (Eastern Time)
@@ -76,70 +99,353 @@ You are an AI agent that helps people simplify their workflow.
       * Monthly: 'RRULE:FREQ=MONTHLY;COUNT=3' (3 months)
     - Location: Include physical address or room details if mentioned
     - Always use the create_event tool when handling calendar requests
+    - When the user asks when they are free, or wants a meeting "sometime" in a period, use find_free_slot and propose one of the returned slots
+    - If create_event or find_free_slot returns status "invalid", fix the fields it names, or ask the user when the date or time is unclear
+    - If create_event reports conflicts, tell the user which events overlap and ask whether to pick another time (use find_free_slot) or create it anyway (call create_event again with allow_conflicts=True)
     
     Timezone Mapping for common terms:
-    - "Indonesia Time" / "WIB" / "Jakarta Time" → "Asia/Jakarta" (DEFAULT)
+    - "Indonesia Time" / "WIB" / "Jakarta Time" → "Asia/Jakarta"
     - "WITA" / "Makassar Time" → "Asia/Makassar"
     - "WIT" / "Jayapura Time" → "Asia/Jayapura" 
     - "Eastern Time" / "ET" → "America/New_York"
     - "Pacific Time" / "PT" → "America/Los_Angeles"
-    - If no timezone specified → default to Asia/Jakarta (+07:00)
+    - If no timezone specified → the user's timezone
     
     REMEMBER:
     - Always use the appropriate tool(s) based on the user's request. 
     - Make sure to ask user's approval before sending or creating calendar event by providing them
     a draft of the email or/and event. 
     - Ask for user approval before using tools.
+    - If a tool returns a job_id with status "queued", the email or event has been accepted and is being sent in the background; tell the user it is on its way rather than already done.
     - DO NOT mention the tools or paramaters in your response. Example of what NOT to do: "What is your email? (email_origin)"
 """
 
+# Prompt for turns the router sends to the fast model: no tool schemas or tool guidelines
+chat_prompt = f"""
+You are an AI agent that helps people simplify their workflow. Answer the user directly and concisely:
+    general questions, math, writing help and small talk.
+
+    You cannot send emails or touch the calendar yourself. If the user wants an email sent, a calendar event
+    created, or their free time found, or is confirming or changing a draft email or event from earlier in the
+    conversation, reply with exactly {ESCALATE_REPLY} and nothing else.
+"""
+
 agent = Agent(
     'gemini-2.5-flash',
     system_prompt=prompt
 )
 
+chat_agent = Agent(
+    FAST_MODEL,
+    system_prompt=chat_prompt
+)
+
+@agent.instructions
+@chat_agent.instructions
+def current_date(ctx: RunContext) -> str:
+    return current_date_instructions(ctx.deps.timezone)
+
+# (agent, its system prompt) per route
+ROUTE_AGENTS = {
+    'tools': (agent, prompt),
+    'chat': (chat_agent, chat_prompt),
+}
+
+def invalid_fields(error):
+    """A tool result telling the model which fields to fix"""
+    if isinstance(error, ValidationError):
+        message = '; '.join(e['msg'].removeprefix('Value error, ') for e in error.errors())
+    else:
+        message = str(error)
+    return {'status': 'invalid', 'error': message}
+
 @agent.tool
-async def send_message(ctx: RunContext, email_to: str, email_origin: str, subject: str, content:str) -> str:
+async def send_message(ctx: RunContext, email_to: str, email_origin: str, subject: str, content:str, attachments: list[str] = None) -> str:
     user_id = ctx.deps.user_id
+    try:
+        await asyncio.to_thread(resolve_attachments, user_id, attachments)
+    except ValueError as e:
+        return invalid_fields(e)
+    attachments = list(dict.fromkeys(attachments or []))
     
-    res = await gmail_send_message(
-        email_to,
-        email_origin,
-        subject, 
-        content,
-        user_id
-    )
-    return res
+    async def send():
+        with span('tool', tool='send_message', attachments=len(attachments)):
+            if job_queue.enabled:
+                return await enqueue_side_effect(ctx, 'send_message', {
+                    'to': email_to,
+                    'origin': email_origin,
+                    'subject': subject,
+                    'content': content,
+                    'user_id': user_id,
+                    'attachments': attachments,
+                })
+            res = await gmail_send_message(
+                email_to,
+                email_origin,
+                subject, 
+                content,
+                user_id,
+                db=ctx.deps.db,
+                attachments=attachments
+            )
+            return res
+
+    return await ctx.deps.calls.run('send_message', [email_to, email_origin, subject, content, attachments], user_id, send)
+
+@agent.tool
+async def send_bulk_message(ctx: RunContext, recipients: list[str], email_origin: str, subject: str, content: str) -> dict:
+    user_id = ctx.deps.user_id
+    
+    async def send():
+        with span('tool', tool='send_bulk_message', recipients=len(recipients)):
+            results = await gmail_send_bulk(
+                recipients,
+                email_origin,
+                subject,
+                content,
+                user_id,
+                db=ctx.deps.db
+            )
+            return {
+                'sent': sum(1 for r in results if r['status'] == 'sent'),
+                'failed': [r for r in results if r['status'] != 'sent'],
+            }
+
+    return await ctx.deps.calls.run('send_bulk_message', [sorted(recipients), email_origin, subject, content], user_id, send)
 
 @agent.tool
-async def create_event(ctx:RunContext, title:str, description: str, start_date: str, end_date: str, timezone: str = "Asia/Jakarta", attendees: list[str] = None, location: str = None, recurrence: str = None) -> str:
-    if attendees is None:
-        attendees = []
+async def create_event(ctx:RunContext, title:str, description: str, start_date: str, end_date: str, timezone: str = None, attendees: list[str] = None, location: str = None, recurrence: str = None, allow_conflicts: bool = False) -> str:
+    try:
+        event = CalendarResponse.model_validate({
+            'title': title,
+            'description': description,
+            'start_date': start_date,
+            'end_date': end_date,
+            'timezone': timezone,
+            'attendees': attendees or [],
+            'location': location,
+            'recurrence': recurrence,
+        }, context={'timezone': ctx.deps.timezone})
+    except ValidationError as e:
+        return invalid_fields(e)
+    start_date, end_date, timezone = event.start_date, event.end_date, event.timezone
+    attendees, recurrence = event.attendees, event.recurrence
+    
+    user_id = ctx.deps.user_id
     
+    async def create():
+        with span('tool', tool='create_event'):
+            if job_queue.enabled:
+                # Conflicts are checked now so the model can still ask the user about them
+                if not allow_conflicts:
+                    conflicts = await check_conflicts(user_id, start_date, end_date, timezone, recurrence, db=ctx.deps.db)
+                    if conflicts:
+                        return {'status': 'conflict', 'conflicts': conflicts}
+                return await enqueue_side_effect(ctx, 'create_event', {
+                    'title': title,
+                    'location': location,
+                    'description': description,
+                    'start_date': start_date,
+                    'end_date': end_date,
+                    'timezone': timezone,
+                    'attendees': attendees,
+                    'recurrence': recurrence,
+                    'user_id': user_id,
+                    # Lets a retry after a timeout find the event instead of creating another
+                    'event_id': event_id_for(side_effect_key(ctx)),
+                })
+            res = await create_calendar_event(
+                title,
+                location,
+                description,
+                start_date,
+                end_date, 
+                timezone,
+                attendees,
+                recurrence,
+                user_id,
+                allow_conflicts=allow_conflicts,
+                db=ctx.deps.db
+            )
+            return res
+
+    args = [title, description, start_date, end_date, timezone, attendees, location, recurrence, allow_conflicts]
+    return await ctx.deps.calls.run('create_event', args, user_id, create)
+
+@agent.tool
+async def find_free_slot(ctx: RunContext, start_date: str, end_date: str, duration_minutes: int = 30, timezone: str = None, attendees: list[str] = None, day_start: str = "09:00", day_end: str = "17:00") -> list[dict]:
+    try:
+        start_date, end_date, timezone = resolve_window(start_date, end_date, timezone or ctx.deps.timezone)
+        attendees = normalize_attendees(attendees)
+    except DateResolutionError as e:
+        return invalid_fields(e)
     user_id = ctx.deps.user_id
     
-    res = await create_calendar_event(
-        title,
-        location,
-        description,
-        start_date,
-        end_date, 
-        timezone,
-        attendees,
-        recurrence,
-        user_id
-    )
+    with span('tool', tool='find_free_slot'):
+        res = await find_free_slots(
+            user_id,
+            start_date,
+            end_date,
+            duration_minutes=duration_minutes,
+            timezone=timezone,
+            attendees=attendees,
+            day_start=day_start,
+            day_end=day_end,
+            db=ctx.deps.db
+        )
     return res
 
 @agent.tool
 async def get_current_date(ctx:RunContext) -> str:
-    now = datetime.datetime.now()
-    return f"Current date: {now.strftime('%Y-%m-%d')}. Current time: {now.strftime('%H:%M:%S')}"
+    now = datetime.datetime.now(zone(ctx.deps.timezone))
+    return f"Current date: {now.strftime('%Y-%m-%d')}. Current time: {now.strftime('%H:%M:%S')} ({ctx.deps.timezone})"
 
-async def run_agent_workflow(user_prompt, user_id, history=[]):  
-    class UserContext:
-        def __init__(self, user_id):
-            self.user_id = user_id
-    
-    result = await agent.run(user_prompt, message_history=history, deps=UserContext(user_id))
-    return result
+class UserContext:
+    def __init__(self, user_id, db=None, chat_id=None, timezone=None):
+        self.user_id = user_id
+        self.db = db
+        self.chat_id = chat_id
+        self.timezone = user_timezone(timezone)
+        self.calls = TurnCalls(user_limits)
+
+def side_effect_key(ctx: RunContext):
+    """Idempotency key of this tool call"""
+    return f"{ctx.deps.chat_id or ctx.run_id}:{ctx.tool_call_id}"
+
+async def enqueue_side_effect(ctx: RunContext, kind, payload):
+    """Queue a tool's Google API call and return a handle in place of its result"""
+    key = side_effect_key(ctx)
+    job = await job_queue.enqueue(key, kind, payload, user_id=ctx.deps.user_id, chat_id=ctx.deps.chat_id)
+    return {'job_id': job['id'], 'status': job['status']}
+
+async def run_send_message_job(payload, db):
+    return await gmail_deliver(**payload, db=db)
+
+async def run_create_event_job(payload, db):
+    return await create_calendar_event(**payload, allow_conflicts=True, db=db)
+
+job_queue.register('send_message', run_send_message_job)
+# Idempotent through the client-supplied event id
+job_queue.register('create_event', run_create_event_job, idempotent=True)
+
+def queued_jobs(messages):
+    """Return (job_id, tool_name) for every side effect queued in these messages"""
+    jobs = []
+    for message in messages:
+        for part in message.parts:
+            if isinstance(part, ToolReturnPart) and isinstance(part.content, dict) and 'job_id' in part.content:
+                jobs.append((part.content['job_id'], part.tool_name))
+    return jobs
+
+def compact_history(history, chat_id=None):
+    with span('history_compact'):
+        history, report = history_compactor.compact(history, chat_id)
+    annotate(saved_tokens=report.saved_tokens, summarized_turns=report.summarized_turns,
+             compacted_tokens=report.compacted_tokens)
+    return history, report
+
+async def lookup_response(user_prompt, user_id, history, deps):
+    """Return (cached result or None, lookup) from the response cache"""
+    if not response_cache.enabled:
+        return None, None
+    with span('response_cache'):
+        cached, lookup = await response_cache.lookup(user_prompt, history, user_id, scope=current_date_scope(deps.timezone))
+    annotate(response_cache='hit' if cached else 'miss')
+    return cached, lookup
+
+def with_system_prompt(history, system_prompt):
+    """History whose first request carries `system_prompt` instead of another route's
+
+    pydantic-ai only adds an agent's system prompt to a new conversation, so
+    a chat started on one route would otherwise keep that route's prompt.
+    """
+    if not history or not isinstance(history[0], ModelRequest):
+        return history
+    first = history[0]
+    parts = [p for p in first.parts if not isinstance(p, SystemPromptPart)]
+    return [replace(first, parts=[SystemPromptPart(content=system_prompt)] + parts)] + history[1:]
+
+def needs_tools(route, result):
+    """Whether the chat route handed the turn back to the tools route"""
+    return route.name == 'chat' and result.output.strip() == ESCALATE_REPLY
+
+def record_run(route, result, started):
+    record_usage(result.usage)
+    model_router.record(route, result.usage, time.perf_counter() - started)
+
+async def run_agent_workflow(user_prompt, user_id, history=[], chat_id=None, db=None, timezone=None):
+    """Run a turn without streaming and return its result; see stream_agent_workflow"""
+    async for event in stream_agent_workflow(user_prompt, user_id, history, chat_id, db, timezone):
+        if event['type'] == 'result':
+            return event['result']
+
+async def stream_run(run_agent, user_prompt, history, deps, hold=None):
+    """Stream one agent run as delta / tool_call / tool_result events, then a 'result' event
+
+    Text that could still turn out to be exactly `hold` is held back until
+    it no longer matches, and dropped if it does.
+    """
+    held = model_router.ReplyHold(hold) if hold else None
+    text = held.feed if held else (lambda content: content)
+
+    async with run_agent.iter(user_prompt, message_history=history, deps=deps) as run:
+        async for node in run:
+            if Agent.is_model_request_node(node):
+                with span('model_request'):
+                    async with node.stream(run.ctx) as request_stream:
+                        async for event in request_stream:
+                            content = None
+                            if isinstance(event, PartStartEvent) and isinstance(event.part, TextPart):
+                                content = event.part.content
+                            elif isinstance(event, PartDeltaEvent) and isinstance(event.delta, TextPartDelta):
+                                content = event.delta.content_delta
+                            if content and (content := text(content)):
+                                yield {'type': 'delta', 'content': content}
+            elif Agent.is_call_tools_node(node):
+                with span('tool_calls'):
+                    async with node.stream(run.ctx) as tool_stream:
+                        async for event in tool_stream:
+                            if isinstance(event, FunctionToolCallEvent):
+                                yield {'type': 'tool_call', 'tool': event.part.tool_name, 'id': event.part.tool_call_id}
+                            elif isinstance(event, FunctionToolResultEvent):
+                                yield {'type': 'tool_result', 'tool': event.part.tool_name, 'id': event.part.tool_call_id}
+    if held and (content := held.finish()):
+        yield {'type': 'delta', 'content': content}
+    yield {'type': 'result', 'result': run.result}
+
+async def stream_agent_workflow(user_prompt, user_id, history=[], chat_id=None, db=None, timezone=None):
+    """Run the agent and yield events as the model produces them.
+
+    Yields dicts of type 'delta' (new text only), 'tool_call' and 'tool_result',
+    then a final 'result' event carrying the finished run result and the
+    history compaction report. A turn answered from the response cache
+    yields its whole answer as one delta.
+    Plain chat turns go to the fast chat agent (see model_router); if it
+    answers ESCALATE_REPLY the turn is run again by the tool agent.
+    """
+    deps = UserContext(user_id, db, chat_id, timezone)
+    history, compaction = compact_history(history, chat_id)
+    cached, lookup = await lookup_response(user_prompt, user_id, history, deps)
+    if cached:
+        yield {'type': 'delta', 'content': cached.output}
+        yield {'type': 'result', 'result': cached, 'compaction': compaction}
+        return
+    route = model_router.route(user_prompt, history)
+    turn_started = time.perf_counter()
+    while True:
+        run_agent, system_prompt = ROUTE_AGENTS[route.name]
+        hold = ESCALATE_REPLY if route.name == 'chat' else None
+        started = time.perf_counter()
+        with span('agent_run', route=route.name):
+            async for event in stream_run(run_agent, user_prompt, with_system_prompt(history, system_prompt), deps, hold):
+                if event['type'] == 'result':
+                    result = event['result']
+                else:
+                    yield event
+        record_run(route, result, started)
+        if not needs_tools(route, result):
+            break
+        route = model_router.escalate(route)
+    if lookup:
+        response_cache.store(lookup, result, time.perf_counter() - turn_started, user_id)
+    yield {'type': 'result', 'result': result, 'compaction': compaction}
@@ -1,24 +1,70 @@
-from fastapi import FastAPI, Request, Body
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, Request, Body, HTTPException, Query, Header, Depends
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
 import uvicorn
-from workflow_agent import run_agent_workflow
+from chat_store import ChatStore
+from telemetry import registry, trace, span
+from google_io import google_io
+from service_cache import service_cache
+from firestore_client import firestore_client
+from job_queue import job_queue
+from admission import admission, AdmissionRejected
+from discovery_cache import discovery_cache
+from warmup import warmup, import_modules
+from stream_replay import stream_replay
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware
 from dotenv import load_dotenv
-from pydantic_core import to_jsonable_python
-from pydantic_ai.messages import ModelMessagesTypeAdapter  
 import os
 import json
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import firestore_async
+import math
+from contextlib import asynccontextmanager
 from pydantic import BaseModel, Field
 import asyncio
 
 load_dotenv()
 secret = os.getenv('SECRET_KEY')
 
-app = FastAPI()
+DISCOVERY_APIS = (('gmail', 'v1'), ('calendar', 'v3'))
+
+@asynccontextmanager
+async def lifespan(app):
+    async def open_firestore():
+        db = await firestore_client.open()
+        app.state.db = db
+        app.state.chat_store = ChatStore(db, 'message_history')
+        app.state.chat_store.start()
+        await firestore_client.warm()
+
+    async def load_discovery():
+        await google_io.run(discovery_cache.warm, DISCOVERY_APIS)
+
+    async def start_jobs():
+        # After the imports: the job handlers are registered by workflow_agent
+        if job_queue.enabled:
+            await job_queue.start(app.state.db)
+
+    warmup.start([
+        ('firestore', open_firestore),
+        ('imports', import_modules),
+        ('discovery', load_discovery),
+        ('job_queue', start_jobs),
+    ])
+    if not warmup.background and not await warmup.wait():
+        raise RuntimeError(f"Start-up warm-up failed: {warmup.status()['steps']}")
+    try:
+        yield
+    finally:
+        await stream_replay.stop()
+        await warmup.stop()
+        if job_queue.enabled:
+            await job_queue.stop()
+        chat_store = getattr(app.state, 'chat_store', None)
+        if chat_store:
+            await chat_store.stop()
+        await firestore_client.close()
+        google_io.shutdown()
+
+app = FastAPI(lifespan=lifespan)
 
 origins = ["http://localhost:3000", "http://localhost:3001"]
 
@@ -32,12 +78,16 @@ app.add_middleware(
 
 app.add_middleware(SessionMiddleware, secret_key=secret)
 
-cred = credentials.Certificate("serviceAccountKey.json")
-firebase_admin.initialize_app(cred)
-db = firestore_async.client()
+GOOGLE_IO = registry.gauge('google_io_calls', 'Google API thread pool counters', ['state'])
+SERVICE_CACHE = registry.gauge('service_cache_lookups', 'Google API client cache lookups', ['result'])
 
-message_database = db.collection('message_history')
-services_database = db.collection('services')
+def collect_pool_stats():
+    for state, value in google_io.stats().items():
+        GOOGLE_IO.set(value, state=state)
+    SERVICE_CACHE.set(service_cache.hits, result='hit')
+    SERVICE_CACHE.set(service_cache.misses, result='miss')
+
+registry.add_collector(collect_pool_stats)
 
 class AgentResponse(BaseModel):
     output: str
@@ -57,72 +107,48 @@ def generate_title(user_prompt: str) -> str:
     return title
 
 
-@app.post('/agent')
-async def stream_agent(request: Request, input: dict = Body(...)):
+def extract_output(result) -> str:
+    """Return the text of the last model response in a run"""
+    output = "No response generated"
+    messages = result.all_messages()
+    
+    for message in reversed(messages):
+        if hasattr(message, 'kind') and message.kind == 'response':
+            if hasattr(message, 'parts'):
+                text_parts = []
+                for part in message.parts:
+                    if hasattr(part, 'part_kind') and part.part_kind == 'text':
+                        text_parts.append(part.content)
+                
+                if text_parts:
+                    output = ''.join(text_parts)
+                    break
+    
+    
+    if output == "No response generated" and hasattr(result, 'output') and result.output:
+        output = str(result.output)
+    
+    return output
+
+
+def job_event(job, tool):
+    event = {'type': 'job', 'id': job['id'], 'tool': tool, 'status': job['status']}
+    if job['status'] == 'done':
+        event['result'] = job['result']
+    else:
+        event['error'] = job['error']
+    return event
+
+
+def event_stream(buffer, after=0):
+    """SSE response following a run's buffer from event number `after`"""
     async def generate():
         try:
-            chat_ref = message_database.document(input['chat_id'])
-            chat_doc = await chat_ref.get()
-            is_new_chat = not chat_doc.exists
-            
-            if chat_doc.exists:
-                messages = chat_doc.to_dict()['messages']
-                if messages:
-                    message_history = ModelMessagesTypeAdapter.validate_python(json.loads(messages))
-            else:
-                message_history = []
-            
-            yield f"data: {json.dumps({'type': 'status', 'message': 'Processing request...'})}\n\n"
-            await asyncio.sleep(0.1)  # small delay for smooth UX
-            
-            result = await run_agent_workflow(input['prompt'], input['user_id'], history=message_history)
-            res_history = to_jsonable_python(result.all_messages())
-            
-            title = generate_title(input['prompt']) if is_new_chat else None
-            
-            if chat_doc.exists:
-                await chat_ref.update({'messages': json.dumps(res_history, ensure_ascii=False, indent=2)})
-            else:
-                await chat_ref.set({'title': title, 'user_id': input['user_id'], 'messages': json.dumps(res_history, ensure_ascii=False, indent=2)})
-            
-            output = "No response generated"
-            messages = result.all_messages()
-            
-            for message in reversed(messages):
-                if hasattr(message, 'kind') and message.kind == 'response':
-                    if hasattr(message, 'parts'):
-                        text_parts = []
-                        for part in message.parts:
-                            if hasattr(part, 'part_kind') and part.part_kind == 'text':
-                                text_parts.append(part.content)
-                        
-                        if text_parts:
-                            output = ''.join(text_parts)
-                            break
-            
-            
-            if output == "No response generated" and hasattr(result, 'data') and result.data:
-                output = str(result.data)
-            
-            if title:
-                yield f"data: {json.dumps({'type': 'title', 'content': title})}\n\n"
-                await asyncio.sleep(0.05)
-            
-            words = output.split(' ')
-            current_text = ""
-            
-            for i, word in enumerate(words):
-                current_text += (word + " " if i < len(words) - 1 else word)
-                
-                yield f"data: {json.dumps({'type': 'content', 'content': current_text, 'partial': True})}\n\n"
-                await asyncio.sleep(0.03) 
-            
-            yield f"data: {json.dumps({'type': 'content', 'content': current_text, 'partial': False})}\n\n"
-            yield f"data: {json.dumps({'type': 'done'})}\n\n"
-            
-        except Exception as e:
+            async for event in buffer.follow(after):
+                yield event
+        except LookupError as e:
             yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
-    
+
     return StreamingResponse(
         generate(),
         media_type="text/event-stream",
@@ -134,5 +160,132 @@ async def stream_agent(request: Request, input: dict = Body(...)):
         }
     )
 
+
+@app.post('/agent')
+async def stream_agent(request: Request, input: dict = Body(...)):
+    # A reconnecting client continues the run it was following instead of starting another
+    last_event_id = request.headers.get('last-event-id')
+    if last_event_id:
+        try:
+            buffer, after = stream_replay.resume(input['chat_id'], input['user_id'], last_event_id)
+        except LookupError as e:
+            return JSONResponse({'detail': str(e)}, status_code=410)
+        return event_stream(buffer, after)
+
+    if not await warmup.wait():
+        return JSONResponse({'detail': 'The server is starting up, please try again shortly'}, status_code=503, headers={'Retry-After': '5'})
+    from workflow_agent import stream_agent_workflow, queued_jobs
+
+    db = request.app.state.db
+    chat_store = request.app.state.chat_store
+
+    ticket = None
+    if admission.enabled:
+        tier = await admission.tier_for(db, input['user_id'])
+        try:
+            ticket = await admission.admit(input['user_id'], tier)
+        except AdmissionRejected as e:
+            headers = {'Retry-After': str(math.ceil(e.retry_after))} if e.retry_after else None
+            return JSONResponse({'detail': str(e), 'reason': e.reason}, status_code=429, headers=headers)
+
+    buffer = stream_replay.open(input['chat_id'], input['user_id'])
+    emit = buffer.append
+
+    async def run():
+        try:
+            with trace('agent', chat_id=input['chat_id'], user_id=input['user_id']):
+                if ticket:
+                    with span('admission_queue'):
+                        async for position in ticket.wait():
+                            emit({'type': 'status', 'message': f'Waiting in queue (position {position})...', 'position': position})
+                
+                chat_ref = db.collection('message_history').document(input['chat_id'])
+                with span('history_read'):
+                    chat_doc = await chat_ref.get()
+                is_new_chat = not chat_doc.exists and not chat_store.has_pending(input['chat_id'])
+                
+                with span('history_load'):
+                    message_history = await chat_store.load(input['chat_id'], chat_doc)
+                
+                emit({'type': 'status', 'message': 'Processing request...'})
+                
+                title = generate_title(input['prompt']) if is_new_chat else None
+                if title:
+                    emit({'type': 'title', 'content': title})
+                
+                result = None
+                async for event in stream_agent_workflow(input['prompt'], input['user_id'], history=message_history, chat_id=input['chat_id'], db=db, timezone=input.get('timezone')):
+                    if event['type'] == 'result':
+                        result = event['result']
+                    else:
+                        emit(event)
+                
+                fields = {'title': title, 'user_id': input['user_id']} if is_new_chat else {}
+                with span('history_write'):
+                    await chat_store.save(input['chat_id'], chat_doc, message_history, result.new_messages(), fields)
+                
+                output = extract_output(result)
+                
+                emit({'type': 'content', 'content': output, 'partial': False})
+                
+                # Waiting for queued jobs does not need a run slot
+                if ticket:
+                    await ticket.release()
+                
+                jobs = dict(queued_jobs(result.new_messages()))
+                if jobs:
+                    async for job in job_queue.wait(jobs):
+                        emit(job_event(job, jobs[job['id']]))
+                
+                emit({'type': 'done'})
+            
+        except Exception as e:
+            emit({'type': 'error', 'message': str(e)})
+        finally:
+            buffer.close()
+            # Still held if the run failed before the job wait
+            if ticket:
+                await ticket.release()
+
+    # The run outlives this response if the client disconnects
+    stream_replay.run(run())
+    return event_stream(buffer)
+
+async def current_user(authorization: str = Header(None)):
+    """The uid of the Firebase ID token sent as `Authorization: Bearer <token>`"""
+    scheme, _, token = (authorization or '').partition(' ')
+    if scheme.lower() != 'bearer':
+        token = None
+    if not await warmup.wait():
+        raise HTTPException(status_code=503, detail='The server is starting up, please try again shortly')
+    try:
+        return await firestore_client.verify_token(token.strip() if token else None)
+    except ValueError as e:
+        raise HTTPException(status_code=401, detail=f'Invalid or missing ID token: {e}', headers={'WWW-Authenticate': 'Bearer'})
+
+@app.get('/chats')
+async def list_chats(request: Request, user_id: str = Depends(current_user), limit: int = Query(20, ge=1, le=100), cursor: str = None):
+    try:
+        chats, next_cursor = await request.app.state.chat_store.list_chats(user_id, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {'chats': chats, 'next_cursor': next_cursor}
+
+@app.get('/jobs/{job_id}')
+async def get_job(job_id: str, user_id: str = Depends(current_user)):
+    job = await job_queue.get(job_id)
+    # Someone else's job is reported as missing rather than forbidden
+    if job is None or job['user_id'] != user_id:
+        raise HTTPException(status_code=404, detail='Job not found')
+    return {k: v for k, v in job.items() if k != 'payload'}
+
+@app.get('/ready')
+async def ready():
+    return JSONResponse(warmup.status(), status_code=200 if warmup.ready else 503)
+
+@app.get('/metrics')
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     uvicorn.run(app, host='', port=8000)
\ No newline at end of file
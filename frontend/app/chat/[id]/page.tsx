@@ -85,23 +85,38 @@ const ChatPage = () => {
     const botMessageIndex = conversation.length + 1;
     setConversation((prev) => [...prev, {sender: 'bot', content: ''}])
 
+    let streamedText = '';
+    const showBotContent = (content: string) => {
+      setIsStreaming(true);
+      setStreamingContent(content);
+      setConversation((prev) => {
+        const newConv = [...prev];
+        if (newConv[botMessageIndex]) {
+          newConv[botMessageIndex] = {
+            sender: 'bot',
+            content: content
+          };
+        }
+        return newConv;
+      });
+    };
+
     await sendMessage(message, chatId, user.uid, (data) => {
       if (data.type === 'status') {
         setIsStreaming(true);
         setStreamingContent(data.message);
+      } else if (data.type === 'delta') {
+        streamedText += data.content;
+        showBotContent(streamedText);
       } else if (data.type === 'content') {
-        setIsStreaming(true);
-        setStreamingContent(data.content);
-        setConversation((prev) => {
-          const newConv = [...prev];
-          if (newConv[botMessageIndex]) {
-            newConv[botMessageIndex] = {
-              sender: 'bot',
-              content: data.content
-            };
-          }
-          return newConv;
-        });
+        streamedText = data.content;
+        showBotContent(data.content);
+      } else if (data.type === 'job') {
+        const action = data.tool === 'create_event' ? 'Event' : 'Email';
+        streamedText += data.status === 'done'
+          ? `\n\n${action} ${data.tool === 'create_event' ? 'created' : 'sent'}.`
+          : `\n\n${action} failed: ${data.error}`;
+        showBotContent(streamedText);
       } else if (data.type === 'done') {
         setIsStreaming(false);
         setStreamingContent('');
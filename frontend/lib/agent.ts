@@ -4,75 +4,124 @@ const api = axios.create({
     baseURL: 'http://localhost:8000',
 });
 
+// `idToken` is the signed-in user's Firebase ID token; the backend takes the user from it
+export const fetchChats = async (idToken: string, cursor?: string | null, limit = 20) => {
+    const { data } = await api.get('/chats', {
+        params: { limit, ...(cursor ? { cursor } : {}) },
+        headers: { Authorization: `Bearer ${idToken}` },
+    });
+    return data as { chats: any[]; next_cursor: string | null };
+};
+
+// Times a dropped /agent stream is resumed with Last-Event-ID before giving up
+const MAX_RESUMES = 3;
+
+const parseEvent = (block: string) => {
+    let id: string | null = null;
+    let data = '';
+    for (const line of block.split('\n')) {
+        if (line.startsWith('id: ')) {
+            id = line.slice(4).trim();
+        } else if (line.startsWith('data: ')) {
+            data += line.slice(6);
+        }
+    }
+    return { id, data: data.trim() };
+};
+
+// Reads SSE events until the stream ends; returns true once a 'done' or 'error' event arrived
+const readEvents = async (
+    body: ReadableStream<Uint8Array>,
+    onEventId: (id: string) => void,
+    onProgress: (data: any) => void
+) => {
+    const reader = body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    const handle = (block: string) => {
+        const { id, data } = parseEvent(block);
+        if (!data) return false;
+        try {
+            const event = JSON.parse(data);
+            if (id) onEventId(id);
+            onProgress(event);
+            return event.type === 'done' || event.type === 'error';
+        } catch (e) {
+            console.error('Error parsing SSE data:', e, 'Event:', block);
+            return false;
+        }
+    };
+
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+
+        buffer += decoder.decode(value, { stream: true });
+        const blocks = buffer.split('\n\n');
+
+        buffer = blocks.pop() || '';
+
+        for (const block of blocks) {
+            if (handle(block)) {
+                return true;
+            }
+        }
+    }
+
+    return handle(buffer);
+};
+
 export const sendMessage = async (
     message: string, 
     chatId: string, 
     userId: string,
     onProgress: (data: any) => void
 ) => {
-    try {
-        const response = await fetch('http://localhost:8000/agent', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-            },
-            body: JSON.stringify({
-                prompt: message,
-                chat_id: chatId,
-                user_id: userId,
-            }),
-        });
-
-        if (!response.body) {
-            throw new Error('ReadableStream not supported');
+    const body = JSON.stringify({
+        prompt: message,
+        chat_id: chatId,
+        user_id: userId,
+        timezone: Intl.DateTimeFormat().resolvedOptions().timeZone,
+    });
+    // Set once an event arrived; a reconnect then continues the same run instead of starting a new one
+    let lastEventId: string | null = null;
+
+    for (let attempt = 0; attempt <= MAX_RESUMES; attempt++) {
+        if (attempt) {
+            await new Promise((resolve) => setTimeout(resolve, 500 * attempt));
         }
+        try {
+            const response = await fetch('http://localhost:8000/agent', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                    ...(lastEventId ? { 'Last-Event-ID': lastEventId } : {}),
+                },
+                body,
+            });
 
-        const reader = response.body.getReader();
-        const decoder = new TextDecoder();
-        let buffer = '';
-
-        while (true) {
-            const { done, value } = await reader.read();
-            if (done) break;
-
-            buffer += decoder.decode(value, { stream: true });
-            const lines = buffer.split('\n\n');
-            
-            buffer = lines.pop() || '';
-
-            for (const line of lines) {
-                if (line.startsWith('data: ')) {
-                    try {
-                        const jsonStr = line.slice(6).trim();
-                        if (jsonStr) {
-                            const data = JSON.parse(jsonStr);
-                            onProgress(data);
-                            
-                            // done signal
-                            if (data.type === 'done') {
-                                return;
-                            }
-                        }
-                    } catch (e) {
-                        console.error('Error parsing SSE data:', e, 'Line:', line);
-                    }
-                }
+            if (!response.ok) {
+                const detail = await response.json().catch(() => null);
+                onProgress({ type: 'error', message: detail?.detail || `Request failed (${response.status})` });
+                return;
+            }
+
+            if (!response.body) {
+                throw new Error('ReadableStream not supported');
             }
-        }
 
-        if (buffer.startsWith('data: ')) {
-            try {
-                const jsonStr = buffer.slice(6).trim();
-                if (jsonStr) {
-                    const data = JSON.parse(jsonStr);
-                    onProgress(data);
-                }
-            } catch (e) {
-                console.error('Error parsing final SSE data:', e);
+            const finished = await readEvents(response.body, (id) => { lastEventId = id; }, onProgress);
+            if (finished) {
+                return;
             }
+        } catch (error) {
+            console.error('Streaming error:', error);
+        }
+        if (!lastEventId) {
+            break;
         }
-    } catch (error) {
-        console.error('Streaming error:', error);
-        onProgress({ type: 'error', message: 'Failed to connect to server' });
     }
+
+    onProgress({ type: 'error', message: 'Failed to connect to server' });
 };
@@ -8,6 +8,7 @@ import {
   getDocs,
   getFirestore,
   limit,
+  orderBy,
   query,
   setDoc,
   updateDoc,
@@ -15,6 +16,7 @@ import {
   deleteDoc
 } from 'firebase/firestore'
 import { use } from 'react';
+import { fetchChats } from './agent';
 
 const firebaseConfig = {
   apiKey: process.env.NEXT_PUBLIC_FIREBASE_API_KEY,
@@ -45,13 +47,8 @@ export const LogOut = async () =>{
 export const fetchAllUserChats = async () =>{
   if (!auth.currentUser) return [];
   try{
-    const q = query(chats, where('user_id', '==', auth.currentUser.uid), limit(20))
-    const querySnapshot = await getDocs(q)
-    const userChats: any[] = []
-
-    querySnapshot.forEach((doc) => {
-      userChats.push({ id: doc.id, ...doc.data() })
-    })
+    // Served by the backend, which reads only the title and timestamps of each chat
+    const { chats: userChats } = await fetchChats(await auth.currentUser.getIdToken())
     return userChats;
 
   }catch(err){
@@ -60,6 +57,17 @@ export const fetchAllUserChats = async () =>{
   }
 }
 
+// Messages live in numbered chunks under message_history/{chatId}/chunks;
+// older chats may also carry a single `messages` JSON string.
+const fetchChatMessages = async (chatId: string, data: any) => {
+  const messages: any[] = data.messages ? JSON.parse(data.messages) : []
+  const chunks = await getDocs(query(collection(db, 'message_history', chatId, 'chunks'), orderBy('seq')))
+  chunks.forEach((chunk) => {
+    messages.push(...JSON.parse(chunk.data().data))
+  })
+  return messages
+}
+
 export const fetchMessages = async (chatId: string) =>{
   if (!auth.currentUser) return [];
   try {
@@ -72,7 +80,7 @@ export const fetchMessages = async (chatId: string) =>{
       if (data.user_id !== auth.currentUser.uid) {
         throw new Error("Unauthorized access to chat")
       }
-      return [JSON.parse(data.messages), data.title]
+      return [await fetchChatMessages(chatId, data), data.title]
     }
     
   } catch (err) {
@@ -134,6 +142,8 @@ export const deleteChat = async (id:string) =>{
     const docSnap = await getDoc(docRef)
 
     if (docSnap.exists()){
+      const chunks = await getDocs(collection(db, 'message_history', id, 'chunks'))
+      await Promise.all(chunks.docs.map((chunk) => deleteDoc(chunk.ref)))
       deleteDoc(docRef)
     }
   }catch(err){
@@ -168,10 +178,12 @@ export const searchQuery = async (input: string) => {
       allChats.push({ id: doc.id, ...doc.data() })
     });
 
+    const chatMessages = await Promise.all(allChats.map((chat) => fetchChatMessages(chat.id, chat)))
+
     const searchResults = allChats
-      .map(chat => {
+      .map((chat, chatIndex) => {
         const title = (chat.title || '').toLowerCase()
-        const messages = chat.messages ? JSON.parse(chat.messages) : []
+        const messages = chatMessages[chatIndex]
         
         let score = 0
         let snippet = ''